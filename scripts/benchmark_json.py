@@ -0,0 +1,114 @@
+import functools
+import sys
+import time
+import typing as tp
+
+from random_pycon_2024_bot import codec
+from random_pycon_2024_bot import db
+from random_pycon_2024_bot import exceptions
+from random_pycon_2024_bot import models
+
+USERS_COUNTS = (1_000, 10_000)
+ROUNDS_COUNT = 40
+UPDATES_COUNT = 10_000
+REPEATS = 3
+STATUSES: list[models.MeetingStatus] = list(models.MeetingStatus)
+
+
+def make_bot_data(users_count: int) -> dict[str, dict[str, tp.Any]]:
+    users = {
+        str(idx): {
+            'user_id': str(idx),
+            'chat_id': str(idx),
+            'username': f'user_{idx}',
+            'enabled': True,
+            'lang_code': 'ru' if idx % 3 else 'en',
+        }
+        for idx in range(users_count)
+    }
+    meetings = {
+        str(idx): [
+            models.CacheMeeting(
+                user_id=sys.intern(str((idx + round_id + 1) % users_count)),
+                status=STATUSES[(idx + round_id) % len(STATUSES)],
+                round_id=round_id,
+            )
+            for round_id in range(ROUNDS_COUNT)
+        ]
+        for idx in range(users_count)
+    }
+    return {'users': users, 'meetings': meetings}
+
+
+def make_updates(updates_count: int) -> bytes:
+    """NDJSON of text messages, as the batch webhook gets them."""
+    updates = [
+        {
+            'update_id': idx,
+            'message': {
+                'message_id': idx,
+                'date': 1_717_232_400 + idx,
+                'chat': {'id': idx, 'type': 'private', 'username': f'user_{idx}', 'first_name': 'Имя'},
+                'from': {'id': idx, 'is_bot': False, 'username': f'user_{idx}', 'first_name': 'Имя'},
+                'text': '/who',
+                'entities': [{'type': 'bot_command', 'offset': 0, 'length': 4}],
+            },
+        }
+        for idx in range(updates_count)
+    ]
+    return '\n'.join(codec.get_codec('json').dumps(update) for update in updates).encode()
+
+
+def best_of(func: tp.Callable[[], object]) -> float:
+    times = []
+    for _ in range(REPEATS):
+        start = time.perf_counter()
+        func()
+        times.append(time.perf_counter() - start)
+    return min(times)
+
+
+def get_codecs() -> list[codec.Codec]:
+    codecs = []
+    for name in codec.CODECS:
+        try:
+            codecs.append(codec.get_codec(name))
+        except exceptions.AppError:
+            print(f'{name}: not installed')  # noqa: T201
+    return codecs
+
+
+def measure_state(codecs: list[codec.Codec], users_count: int) -> None:
+    bot_data = make_bot_data(users_count)
+    print(f'bot_data of {users_count} users, {ROUNDS_COUNT} meetings each')  # noqa: T201
+    for json_codec in codecs:
+        text = json_codec.dumps(bot_data, default=db.meeting_to_json)
+        dumps_time = best_of(functools.partial(json_codec.dumps, bot_data, default=db.meeting_to_json))
+        loads_time = best_of(functools.partial(json_codec.loads, text))
+        print(  # noqa: T201
+            f'  {json_codec.name:>8}: dumps {dumps_time * 1000:7.1f} ms, loads {loads_time * 1000:7.1f} ms, '
+            f'{len(text.encode()) / 2**20:.1f} MiB'
+        )
+
+
+def load_lines(json_codec: codec.Codec, lines: list[bytes]) -> list[tp.Any]:
+    return [json_codec.loads(line) for line in lines]
+
+
+def measure_updates(codecs: list[codec.Codec]) -> None:
+    lines = make_updates(UPDATES_COUNT).splitlines()
+    print(f'{UPDATES_COUNT} webhook updates')  # noqa: T201
+    for json_codec in codecs:
+        loads_time = best_of(functools.partial(load_lines, json_codec, lines))
+        print(f'  {json_codec.name:>8}: loads {loads_time * 1000:7.1f} ms')  # noqa: T201
+
+
+def main() -> None:
+    codecs = get_codecs()
+    for users_count in USERS_COUNTS:
+        measure_state(codecs, users_count)
+    measure_updates(codecs)
+
+
+if __name__ == '__main__':
+    main()
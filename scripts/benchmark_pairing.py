@@ -0,0 +1,61 @@
+import collections
+import os
+import time
+import tracemalloc
+
+from random_pycon_2024_bot import pairing
+
+USERS_COUNTS = (10_000, 50_000)
+ROUNDS_COUNT = 100
+USERNAME_LENGTH = 100
+
+
+def get_random_hex(idx: int) -> str:
+    rand = os.urandom(USERNAME_LENGTH).hex()
+    return f'{rand}_{idx}'[-USERNAME_LENGTH:]
+
+
+def measure(users_count: int) -> None:
+    users = [get_random_hex(idx) for idx in range(users_count)]
+
+    met = pairing.MetMatrix()
+    for user in users:
+        met.intern(user)
+    legacy: dict[str, set[str]] = collections.defaultdict(set)
+    legacy_size = 0
+    round_times = []
+    for idx in range(ROUNDS_COUNT):
+        start = time.perf_counter()
+        new_round = pairing.make_round(users, met, seed=idx)
+        round_times.append(time.perf_counter() - start)
+        for left, right in new_round.pairs:
+            met.add(met.ids[left], met.ids[right])
+
+        # tracemalloc slows down allocations, trace only the legacy structure
+        tracemalloc.start()
+        for left, right in new_round.pairs:
+            legacy[left].add(right)
+            legacy[right].add(left)
+        legacy_size += tracemalloc.get_traced_memory()[0]
+        tracemalloc.stop()
+
+    start = time.perf_counter()
+    matching_round = pairing.make_round(users, met, algorithm='matching', seed=ROUNDS_COUNT)
+    matching_time = time.perf_counter() - start
+
+    print(f'{users_count} users, {ROUNDS_COUNT} rounds')  # noqa: T201
+    print(f'  met matrix: {met.nbytes() / 2**20:.1f} MiB')  # noqa: T201
+    print(f'  dict of sets: {legacy_size / 2**20:.1f} MiB')  # noqa: T201
+    print(f'  dense bitsets would take: {users_count * users_count / 8 / 2**20:.1f} MiB')  # noqa: T201
+    avg_time = sum(round_times) / len(round_times)
+    print(f'  greedy round: avg {avg_time * 1000:.1f} ms, max {max(round_times) * 1000:.1f} ms')  # noqa: T201
+    print(f'  matching round: {matching_time * 1000:.1f} ms, repeats {matching_round.repeats}')  # noqa: T201
+
+
+def main() -> None:
+    for users_count in USERS_COUNTS:
+        measure(users_count)
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,27 @@
+import pathlib
+import time
+
+from random_pycon_2024_bot import history
+
+HISTORY_DIR = pathlib.Path(__file__).parent.parent / 'history'
+BINARY_PATH = HISTORY_DIR / 'history.bin'
+
+
+def main() -> None:
+    paths = history.iter_history_files(HISTORY_DIR)
+    size = sum(path.stat().st_size for path in paths)
+
+    start = time.perf_counter()
+    converted = history.convert_history(paths, BINARY_PATH)
+    print(f'Converted {len(paths)} files in {time.perf_counter() - start:.2f} s')  # noqa: T201
+    print(f'text: {size / 2**20:.1f} MiB, binary: {BINARY_PATH.stat().st_size / 2**20:.1f} MiB')  # noqa: T201
+
+    start = time.perf_counter()
+    with history.BinaryHistory(BINARY_PATH) as binary:
+        meetings_count = sum(len(binary.round(round_idx)) // 2 for round_idx in range(len(binary)))
+        print(f'Read {meetings_count} meetings of {len(binary)} rounds in {time.perf_counter() - start:.4f} s')  # noqa: T201
+        assert meetings_count == len(converted)  # noqa: S101
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,31 @@
+import pathlib
+import resource
+import sys
+import time
+
+from random_pycon_2024_bot import history
+
+HISTORY_DIR = pathlib.Path(__file__).parent.parent / 'history'
+
+
+def main() -> None:
+    # python import_history.py [workers], files are parsed in a process pool if workers > 1
+    workers = int(sys.argv[1]) if len(sys.argv) > 1 else 1
+    paths = history.iter_history_files(HISTORY_DIR)
+    size = sum(path.stat().st_size for path in paths)
+
+    start = time.perf_counter()
+    loaded = history.load_history_parallel(paths, workers=workers) if workers > 1 else history.load_history(paths)
+    elapsed = time.perf_counter() - start
+
+    # ru_maxrss is in kilobytes on Linux
+    peak_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 2**10
+    print(f'{len(paths)} files, {size / 2**20:.1f} MiB')  # noqa: T201
+    print(f'{len(loaded)} meetings of {len(loaded.met.users)} users in {elapsed:.2f} s')  # noqa: T201
+    print(f'{len(loaded) / elapsed:.0f} meetings/s, {size / 2**20 / elapsed:.1f} MiB/s')  # noqa: T201
+    print(f'columns: {loaded.nbytes() / 2**20:.1f} MiB, met matrix: {loaded.met.nbytes() / 2**20:.1f} MiB')  # noqa: T201
+    print(f'peak RSS: {peak_rss:.1f} MiB')  # noqa: T201
+
+
+if __name__ == '__main__':
+    main()
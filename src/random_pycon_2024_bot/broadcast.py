@@ -0,0 +1,383 @@
+import asyncio
+import collections
+import contextlib
+import dataclasses
+import datetime
+import enum
+import functools
+import logging
+import time
+import typing as tp
+import uuid
+import weakref
+
+import sqlalchemy as sa
+from sqlalchemy.ext.asyncio import async_sessionmaker
+import telegram as t
+import telegram.error
+import telegram.ext as te
+
+from random_pycon_2024_bot import db
+from random_pycon_2024_bot import models
+from random_pycon_2024_bot.settings import settings
+
+logger = logging.getLogger(__name__)
+
+RATE_WINDOW = 10.0
+
+_broadcasters: 'weakref.WeakKeyDictionary[te.Application, Broadcaster]' = weakref.WeakKeyDictionary()  # type: ignore[type-arg]
+
+
+class TokenBucket:
+    """Allow `rate` acquisitions per second on average with bursts of up to `capacity`."""
+
+    def __init__(self, rate: float, capacity: float | None = None) -> None:
+        self.rate = rate
+        self.capacity = capacity if capacity is not None else max(rate, 1)
+        self._tokens = self.capacity
+        self._updated = time.monotonic()
+        # waiters are served in order
+        self._lock = asyncio.Lock()
+
+    async def acquire(self) -> None:
+        async with self._lock:
+            while True:
+                self._refill()
+                if self._tokens >= 1:
+                    self._tokens -= 1
+                    return
+                await asyncio.sleep((1 - self._tokens) / self.rate)
+
+    def block(self, seconds: float) -> None:
+        """Hand out no tokens for `seconds`, e.g. after Telegram asked to retry later."""
+        self._tokens = 0
+        self._updated = max(self._updated, time.monotonic() + seconds)
+
+    def is_full(self) -> bool:
+        self._refill()
+        return self._tokens >= self.capacity
+
+    def _refill(self) -> None:
+        now = time.monotonic()
+        if now > self._updated:
+            self._tokens = min(self.capacity, self._tokens + (now - self._updated) * self.rate)
+            self._updated = now
+
+
+class RateMeter:
+    """Count events per second over the last `window` seconds."""
+
+    def __init__(self, window: float) -> None:
+        self.window = window
+        self._events: collections.deque[float] = collections.deque()
+
+    def add(self) -> None:
+        self._events.append(time.monotonic())
+
+    def rate(self) -> float:
+        threshold = time.monotonic() - self.window
+        while self._events and self._events[0] < threshold:
+            self._events.popleft()
+        return len(self._events) / self.window
+
+
+@enum.unique
+class JobStatus(enum.StrEnum):
+    running = enum.auto()
+    done = enum.auto()
+
+
+@dataclasses.dataclass
+class BroadcastJob:
+    job_id: str
+    total: int
+    sent: int = 0
+    failed: int = 0
+    retried: int = 0
+    forbidden: int = 0
+    status: JobStatus = JobStatus.running
+    started_at: datetime.datetime = dataclasses.field(default_factory=lambda: datetime.datetime.now(tz=datetime.UTC))
+    finished_at: datetime.datetime | None = None
+
+    @property
+    def queued(self) -> int:
+        return max(self.total - self.sent - self.failed - self.forbidden, 0)
+
+    def count(self, status: models.OutboxStatus) -> None:
+        if status == models.OutboxStatus.sent:
+            self.sent += 1
+        elif status == models.OutboxStatus.forbidden:
+            self.forbidden += 1
+        elif status == models.OutboxStatus.failed:
+            self.failed += 1
+        if self.status == JobStatus.running and self.sent + self.failed + self.forbidden >= self.total:
+            self.status = JobStatus.done
+            self.finished_at = datetime.datetime.now(tz=datetime.UTC)
+
+
+@dataclasses.dataclass
+class JobStats:
+    job: BroadcastJob
+    queued: int
+    eta_seconds: float | None
+
+
+@dataclasses.dataclass
+class BroadcastStats:
+    queued: int
+    sent: int
+    failed: int
+    forbidden: int
+    rate_limited: int
+    # messages per second over the last `RATE_WINDOW` seconds and the configured limit
+    rate: float
+    rate_limit: float
+    eta_seconds: float | None
+    jobs: list[JobStats]
+
+
+@dataclasses.dataclass
+class OutboxItem:
+    chat_id: str
+    text: str
+    # enqueueing a message with a known key does nothing
+    key: str
+    parse_mode: str | None = None
+
+
+class Broadcaster:
+    """
+    Durable outbox of Telegram messages and the dispatcher which drains it.
+
+    Messages are stored in the `outbox_message` table before they are sent, so a restart resumes an
+    interrupted broadcast. The dispatcher takes the oldest pending message of every chat in batches:
+    up to `concurrency` sends are in flight, all of them share the global rate limit and every chat gets
+    at most `chat_rate` messages per second. Sends are retried after `RetryAfter`, which also pauses
+    the global limit, `on_forbidden` is called with the chat id when a user has blocked the bot.
+    Messages are marked after every batch, so a crash resends at most one batch.
+    """
+
+    def __init__(  # noqa: PLR0913
+        self,
+        db_engine: sa.Engine,
+        *,
+        concurrency: int,
+        rate: float,
+        chat_rate: float,
+        max_retries: int,
+        batch_size: int,
+        poll_interval: float,
+        retention: datetime.timedelta,
+        on_forbidden: tp.Callable[[str], None] | None = None,
+    ) -> None:
+        self.jobs: dict[str, BroadcastJob] = {}
+        self._sessionmaker = async_sessionmaker(bind=db_engine, expire_on_commit=False)  # type: ignore[call-overload]
+        self._chat_rate = chat_rate
+        self._max_retries = max_retries
+        self._batch_size = batch_size
+        self._poll_interval = poll_interval
+        self._retention = retention
+        self._on_forbidden = on_forbidden
+        self._semaphore = asyncio.Semaphore(concurrency)
+        self._bucket = TokenBucket(rate)
+        self._meter = RateMeter(RATE_WINDOW)
+        self._totals: collections.Counter[models.OutboxStatus] = collections.Counter()
+        self._rate_limited = 0
+        self._queued = 0
+        self._chat_buckets: dict[str, TokenBucket] = {}
+        self._wakeup = asyncio.Event()
+        self._stopping = False
+        self._task: asyncio.Task[None] | None = None
+
+    async def enqueue(self, items: tp.Iterable[OutboxItem], job_id: str | None = None) -> int:
+        """Store the messages for the dispatcher and return the number of new ones."""
+        values = [
+            {
+                'key': item.key,
+                'chat_id': item.chat_id,
+                'text': item.text,
+                'parse_mode': item.parse_mode,
+                'job_id': job_id,
+            }
+            for item in items
+        ]
+        async with self._sessionmaker.begin() as session:
+            enqueued = await db.enqueue_outbox(session, values)
+        self._queued += enqueued
+        self._wakeup.set()
+        return enqueued
+
+    async def start(self, items: tp.Iterable[OutboxItem]) -> BroadcastJob:
+        """Enqueue the messages as a job and return right away, the job is updated as messages are sent."""
+        job = BroadcastJob(job_id=uuid.uuid4().hex[:8], total=0)
+        job.total = await self.enqueue(items, job_id=job.job_id)
+        self._evict_jobs()
+        if job.total:
+            self.jobs[job.job_id] = job
+            logger.info('Broadcast %s started for %d users', job.job_id, job.total)
+        else:
+            job.status, job.finished_at = JobStatus.done, job.started_at
+        return job
+
+    def _evict_jobs(self) -> None:
+        """Forget the jobs which finished before the retention period, their messages are purged after it too."""
+        before = datetime.datetime.now(tz=datetime.UTC) - self._retention
+        self.jobs = {
+            job_id: job for job_id, job in self.jobs.items() if job.finished_at is None or job.finished_at >= before
+        }
+
+    def stats(self) -> BroadcastStats:
+        self._evict_jobs()
+        rate = self._meter.rate()
+        jobs = [
+            JobStats(job=job, queued=job.queued, eta_seconds=_eta(job.queued, rate))
+            for job in sorted(self.jobs.values(), key=lambda job: job.started_at, reverse=True)
+        ]
+        return BroadcastStats(
+            queued=self._queued,
+            sent=self._totals[models.OutboxStatus.sent],
+            failed=self._totals[models.OutboxStatus.failed],
+            forbidden=self._totals[models.OutboxStatus.forbidden],
+            rate_limited=self._rate_limited,
+            rate=rate,
+            rate_limit=self._bucket.rate,
+            eta_seconds=_eta(self._queued, rate),
+            jobs=jobs,
+        )
+
+    def job_stats(self, job_id: str) -> JobStats | None:
+        job = self.jobs.get(job_id)
+        if job is None:
+            return None
+        return JobStats(job=job, queued=job.queued, eta_seconds=_eta(job.queued, self._meter.rate()))
+
+    def start_dispatcher(self, bot: t.Bot) -> None:
+        if self._task is None:
+            self._stopping = False
+            self._task = asyncio.create_task(self._dispatch(bot), name='outbox_dispatcher')
+
+    async def stop_dispatcher(self) -> None:
+        """Let the current batch finish and stop."""
+        if self._task is None:
+            return
+        self._stopping = True
+        self._wakeup.set()
+        await self._task
+        self._task = None
+
+    async def _dispatch(self, bot: t.Bot) -> None:
+        try:
+            await self._restore()
+        except Exception:
+            logger.exception('Failed to restore the outbox')
+        while not self._stopping:
+            self._wakeup.clear()
+            try:
+                if await self._dispatch_batch(bot):
+                    continue
+            except Exception:
+                logger.exception('Failed to dispatch the outbox')
+            with contextlib.suppress(TimeoutError):
+                await asyncio.wait_for(self._wakeup.wait(), timeout=self._poll_interval)
+
+    async def _dispatch_batch(self, bot: t.Bot) -> bool:
+        async with self._sessionmaker() as session:
+            batch = await db.fetch_outbox(session, self._batch_size)
+        if not batch:
+            return False
+        statuses = dict(await asyncio.gather(*(self._deliver(bot, message) for message in batch)))
+        async with self._sessionmaker.begin() as session:
+            await db.mark_outbox(session, statuses)
+        self._queued = max(self._queued - len(batch), 0)
+        for message in batch:
+            job = self.jobs.get(message.job_id or '')
+            if job is not None:
+                job.count(statuses[message.id])
+        # chats whose limit has recovered don't need their buckets anymore
+        self._chat_buckets = {chat_id: bucket for chat_id, bucket in self._chat_buckets.items() if not bucket.is_full()}
+        return True
+
+    async def _deliver(self, bot: t.Bot, message: models.OutboxMessage) -> tuple[int, models.OutboxStatus]:
+        status = await self._send(bot, message)
+        self._totals[status] += 1
+        self._meter.add()
+        return message.id, status
+
+    async def _send(self, bot: t.Bot, message: models.OutboxMessage) -> models.OutboxStatus:
+        chat_bucket = self._chat_buckets.get(message.chat_id)
+        if chat_bucket is None:
+            chat_bucket = self._chat_buckets[message.chat_id] = TokenBucket(self._chat_rate, capacity=1)
+        async with self._semaphore:
+            for _ in range(self._max_retries + 1):
+                await chat_bucket.acquire()
+                await self._bucket.acquire()
+                try:
+                    await bot.send_message(chat_id=message.chat_id, text=message.text, parse_mode=message.parse_mode)
+                except telegram.error.RetryAfter as exc:
+                    seconds = _retry_seconds(exc)
+                    logger.warning('Outbox is rate limited for %s seconds', seconds)
+                    self._rate_limited += 1
+                    job = self.jobs.get(message.job_id or '')
+                    if job is not None:
+                        job.retried += 1
+                    self._bucket.block(seconds)
+                    chat_bucket.block(seconds)
+                    continue
+                except telegram.error.Forbidden:
+                    if self._on_forbidden is not None:
+                        self._on_forbidden(message.chat_id)
+                    return models.OutboxStatus.forbidden
+                except telegram.error.TelegramError:
+                    logger.exception('Failed to send message %s to %s', message.id, message.chat_id)
+                    return models.OutboxStatus.failed
+                return models.OutboxStatus.sent
+        return models.OutboxStatus.failed
+
+    async def _restore(self) -> None:
+        """Drop old messages and pick up the jobs interrupted by a restart."""
+        before = datetime.datetime.now(tz=datetime.UTC).replace(tzinfo=None) - self._retention
+        async with self._sessionmaker.begin() as session:
+            purged = await db.purge_outbox(session, before)
+            counts = await db.count_outbox_jobs(session)
+            self._queued = await db.count_pending_outbox(session)
+        for job_id, job_counts in counts.items():
+            if job_id in self.jobs:
+                continue
+            self.jobs[job_id] = BroadcastJob(
+                job_id=job_id,
+                total=sum(job_counts.values()),
+                sent=job_counts.get(models.OutboxStatus.sent, 0),
+                failed=job_counts.get(models.OutboxStatus.failed, 0),
+                forbidden=job_counts.get(models.OutboxStatus.forbidden, 0),
+            )
+        logger.info('Purged %d outbox messages, resuming %d broadcasts', purged, len(counts))
+
+
+def _eta(queued: int, rate: float) -> float | None:
+    return queued / rate if rate else None
+
+
+def _retry_seconds(exc: telegram.error.RetryAfter) -> float:
+    # an int before python-telegram-bot 22, a timedelta after
+    retry_after = exc.retry_after
+    return retry_after.total_seconds() if isinstance(retry_after, datetime.timedelta) else retry_after
+
+
+def setup(application: te.Application, db_engine: sa.Engine) -> Broadcaster:  # type: ignore[type-arg]
+    # not in bot_data: it is deep-copied for persistence and the broadcaster holds locks and tasks
+    broadcaster = _broadcasters[application] = Broadcaster(
+        db_engine,
+        concurrency=settings.broadcast_concurrency,
+        rate=settings.broadcast_rate,
+        chat_rate=settings.broadcast_chat_rate,
+        max_retries=settings.broadcast_max_retries,
+        batch_size=settings.outbox_batch_size,
+        poll_interval=settings.outbox_poll_interval,
+        retention=datetime.timedelta(days=settings.outbox_retention_days),
+        on_forbidden=functools.partial(db.block_user, te.CallbackContext(application)),
+    )
+    return broadcaster
+
+
+def get_broadcaster(application: te.Application) -> Broadcaster:  # type: ignore[type-arg]
+    return _broadcasters[application]
@@ -0,0 +1,88 @@
+import dataclasses
+import importlib
+import json
+import typing as tp
+
+from random_pycon_2024_bot import exceptions
+from random_pycon_2024_bot.settings import settings
+
+EncodeHook = tp.Callable[[tp.Any], tp.Any]
+
+
+class Dumps(tp.Protocol):
+    def __call__(self, obj: tp.Any, default: EncodeHook | None = None) -> str: ...  # noqa: ANN401
+
+
+@dataclasses.dataclass(frozen=True)
+class Codec:
+    """
+    JSON functions of one library.
+
+    `dumps` returns text and calls `default` for objects the library can't encode, `loads` takes text or bytes.
+    msgspec and orjson encode dataclasses by themselves, and they don't escape non-ASCII characters.
+    """
+
+    name: str
+    dumps: Dumps
+    loads: tp.Callable[[str | bytes], tp.Any]
+
+
+def _stdlib_codec() -> Codec:
+    def dumps(obj: tp.Any, default: EncodeHook | None = None) -> str:  # noqa: ANN401
+        return json.dumps(obj, default=default)
+
+    return Codec(name='json', dumps=dumps, loads=json.loads)
+
+
+def _msgspec_codec() -> Codec:
+    msgspec_json = importlib.import_module('msgspec.json')
+    encoders: dict[EncodeHook | None, tp.Any] = {None: msgspec_json.Encoder()}
+    decoder = msgspec_json.Decoder()
+
+    def dumps(obj: tp.Any, default: EncodeHook | None = None) -> str:  # noqa: ANN401
+        encoder = encoders.get(default)
+        if encoder is None:
+            encoder = encoders[default] = msgspec_json.Encoder(enc_hook=default)
+        return tp.cast(bytes, encoder.encode(obj)).decode()
+
+    return Codec(name='msgspec', dumps=dumps, loads=decoder.decode)
+
+
+def _orjson_codec() -> Codec:
+    orjson = importlib.import_module('orjson')
+
+    def dumps(obj: tp.Any, default: EncodeHook | None = None) -> str:  # noqa: ANN401
+        # int keys of `user_data` and `chat_data` are turned into strings like the standard library does
+        return tp.cast(bytes, orjson.dumps(obj, default=default, option=orjson.OPT_NON_STR_KEYS)).decode()
+
+    return Codec(name='orjson', dumps=dumps, loads=orjson.loads)
+
+
+# `auto` takes the first library that is installed
+CODECS: dict[str, tp.Callable[[], Codec]] = {
+    'orjson': _orjson_codec,
+    'msgspec': _msgspec_codec,
+    'json': _stdlib_codec,
+}
+
+
+def get_codec(name: str = 'auto') -> Codec:
+    if name == 'auto':
+        for factory in CODECS.values():
+            try:
+                return factory()
+            except ImportError:
+                continue
+    if name not in CODECS:
+        msg = f'Unknown JSON codec {name}, choose one of {", ".join(CODECS)}'
+        raise exceptions.AppError(msg)
+    try:
+        return CODECS[name]()
+    except ImportError as exc:
+        msg = f'JSON codec {name} is not installed'
+        raise exceptions.AppError(msg) from exc
+
+
+codec = get_codec(settings.json_codec)
+dumps = codec.dumps
+loads = codec.loads
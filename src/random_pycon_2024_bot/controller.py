@@ -1,6 +1,8 @@
 from __future__ import annotations
 
+import collections
 import datetime
+import hmac
 import json
 import logging
 import typing as tp
@@ -10,18 +12,75 @@ import litestar as ls
 from litestar import datastructures as ds
 import telegram as t
 
+from random_pycon_2024_bot import broadcast
+from random_pycon_2024_bot import codec
 from random_pycon_2024_bot import models
+from random_pycon_2024_bot import updates
+from random_pycon_2024_bot.settings import settings
 
 logger = logging.getLogger(__name__)
 
+# seconds Telegram or a replaying client is asked to wait when the update queue is full
+RETRY_AFTER = 1
+BATCH_AUTH_HEADER = 'X-Batch-Secret'
+
+
+def parse_updates(body: bytes) -> list[dict[str, tp.Any]]:
+    """Parse a JSON array of updates or NDJSON, one update per line."""
+    body = body.strip()
+    if body.startswith(b'['):
+        data = codec.loads(body)
+    else:
+        data = [codec.loads(line) for line in body.splitlines() if line.strip()]
+    if not isinstance(data, list) or not all(isinstance(item, dict) for item in data):
+        msg = 'Expected JSON objects of updates'
+        raise ValueError(msg)
+    return data
+
 
 class RootController(ls.Controller):
     path = ''
 
     @ls.post('/telegram')
     async def telegram(self, data: dict[str, tp.Any], state: ds.State) -> None:
-        """Handle incoming Telegram updates by putting them into the `update_queue`."""
-        await state.tg_app.update_queue.put(t.Update.de_json(data=data, bot=state.tg_app.bot))
+        """Handle incoming Telegram updates by putting them into the `update_queue`, 429 makes Telegram retry."""
+        update = t.Update.de_json(data=data, bot=state.tg_app.bot)
+        if updates.get_update_queue(state.tg_app).offer(update) == updates.Offer.rejected:
+            raise ls.exceptions.TooManyRequestsException(
+                detail='Too many updates are queued',
+                headers={'Retry-After': str(RETRY_AFTER)},
+            )
+
+    @ls.post('/telegram/batch', status_code=202)
+    async def telegram_batch(
+        self, request: ls.Request[tp.Any, tp.Any, tp.Any], state: ds.State
+    ) -> dict[updates.Offer, int]:
+        """
+        Put a batch of updates into the `update_queue`, for replays and load tests.
+
+        The body is a JSON array or NDJSON. The whole batch is rejected with 429 if it would take the queue
+        above `update_queue_high_water`, so the client retries it later instead of piling updates up.
+        Updates are trusted as they come, admin commands included, so the endpoint needs `batch_secret`.
+        """
+        if settings.batch_secret is None:
+            raise ls.exceptions.NotFoundException(detail='Batches of updates are disabled')
+        secret = request.headers.get(BATCH_AUTH_HEADER, '')
+        if not hmac.compare_digest(secret.encode(), settings.batch_secret.encode()):
+            raise ls.exceptions.NotAuthorizedException(detail=f'Invalid {BATCH_AUTH_HEADER} header')
+        try:
+            data = parse_updates(await request.body())
+        except ValueError as exc:
+            raise ls.exceptions.ValidationException(detail=f'Invalid batch of updates: {exc}') from exc
+        update_queue = updates.get_update_queue(state.tg_app)
+        if update_queue.qsize() + len(data) > settings.update_queue_high_water:
+            raise ls.exceptions.TooManyRequestsException(
+                detail=f'{update_queue.qsize()} updates are queued already',
+                headers={'Retry-After': str(RETRY_AFTER)},
+            )
+        offers = collections.Counter(
+            update_queue.offer(update) for update in t.Update.de_list(data=data, bot=state.tg_app.bot)
+        )
+        return {offer: offers[offer] for offer in updates.Offer}
 
     @ls.post(path='/submitpayload')
     async def custom_updates(self, data: models.WebhookUpdate, state: ds.State) -> None:
@@ -37,6 +96,23 @@ class RootController(ls.Controller):
         """For the health endpoint, reply with a simple plain text message."""
         return 'The bot is still running fine :)'
 
+    @ls.get('/updates')
+    async def update_stats(self, state: ds.State) -> updates.QueueStats:
+        """Report the depth of the `update_queue`, the age of its oldest update and how many were shed."""
+        return updates.get_update_queue(state.tg_app).stats()
+
+    @ls.get('/broadcasts')
+    async def broadcasts(self, state: ds.State) -> broadcast.BroadcastStats:
+        """Report the outbox progress: totals, current rate, ETA and every broadcast job."""
+        return broadcast.get_broadcaster(state.tg_app).stats()
+
+    @ls.get('/broadcasts/{job_id:str}')
+    async def broadcast_job(self, job_id: str, state: ds.State) -> broadcast.JobStats:
+        stats = broadcast.get_broadcaster(state.tg_app).job_stats(job_id)
+        if stats is None:
+            raise ls.exceptions.NotFoundException(detail=f'Unknown broadcast {job_id}')
+        return stats
+
     @ls.post('/parse')
     async def parse(self, data: str) -> dict[str, str]:
         return json.loads(data)[0]
@@ -1,7 +1,12 @@
 import collections
-import functools
+import contextlib
+import dataclasses
+import datetime
+import itertools
 import logging
+import sys
 import typing as tp
+import weakref
 
 import sqlalchemy as sa
 from sqlalchemy.dialects.sqlite import insert as sqlite_upsert
@@ -9,18 +14,55 @@ import telegram as t
 import telegram.ext as te
 
 from random_pycon_2024_bot import exceptions
+from random_pycon_2024_bot import history
+from random_pycon_2024_bot import locks
 from random_pycon_2024_bot import models
+from random_pycon_2024_bot import pairing
 from random_pycon_2024_bot.utils import notnull
 
 logger = logging.getLogger(__name__)
 
+_T = tp.TypeVar('_T')
+
+# keeps every statement well below the SQLite limit on bound parameters
+ENTRIES_CHUNK_SIZE = 500
+
+# not in bot_data: it is deep-copied for persistence and locks can't be copied
+_user_locks: 'weakref.WeakKeyDictionary[te.Application, locks.KeyedLocks]' = weakref.WeakKeyDictionary()  # type: ignore[type-arg]
+
+
+@dataclasses.dataclass
+class _Indexes:
+    """Runtime indexes of `bot_data`, each is built from it on first use and so rebuilt after a restart."""
+
+    pairs: dict[tuple[str, str], list[models.CacheMeeting]] | None = None
+    waiting: dict[str, models.CacheMeeting] | None = None
+    blocked: set[str] | None = None
+    counters: models.MeetingCounters | None = None
+
+
+# not in bot_data either: it is deep-copied for persistence after every update, the indexes would be copied too
+_indexes: 'weakref.WeakKeyDictionary[te.Application, _Indexes]' = weakref.WeakKeyDictionary()  # type: ignore[type-arg]
+
+
+def _get_indexes(context: te.ContextTypes.DEFAULT_TYPE) -> _Indexes:
+    indexes = _indexes.get(context.application)
+    if indexes is None:
+        indexes = _indexes[context.application] = _Indexes()
+    return indexes
+
 
 def _get_users(context: te.ContextTypes.DEFAULT_TYPE) -> dict[str, models.TelegramUser]:
     return notnull(context.bot_data).setdefault('users', {})  # type: ignore[no-any-return]
 
 
-@functools.cache
 def get_user(context: te.ContextTypes.DEFAULT_TYPE, user_id: int | str) -> models.TelegramUser:
+    """
+    Return the user from `bot_data`, an unknown user is added empty.
+
+    `bot_data['users']` is the only cache of users: it is keyed by user id, lives as long as the application
+    and is replaced as a whole when persistence reloads it, so the returned dict is never stale.
+    """
     users = _get_users(context)
     return users.setdefault(str(user_id), {})  # type: ignore[typeddict-item]
 
@@ -38,36 +80,345 @@ def get_login(context: te.ContextTypes.DEFAULT_TYPE, username: str) -> models.Te
     if user is None:
         msg = f'Unknown login: {username}'
         raise exceptions.UnknownLoginError(msg)
+    return user
+
+
+def _get_blocked(context: te.ContextTypes.DEFAULT_TYPE) -> set[str]:
+    """Ids of users who have blocked the bot, built lazily from `blocked_at` of the users."""
+    indexes = _get_indexes(context)
+    if indexes.blocked is None:
+        indexes.blocked = {user_id for user_id, user in _get_users(context).items() if 'blocked_at' in user}
+    return indexes.blocked
+
+
+def is_blocked(context: te.ContextTypes.DEFAULT_TYPE, user_id: int | str) -> bool:
+    return str(user_id) in _get_blocked(context)
+
+
+def count_blocked_users(context: te.ContextTypes.DEFAULT_TYPE) -> int:
+    return len(_get_blocked(context))
+
+
+def block_user(context: te.ContextTypes.DEFAULT_TYPE, user_id: int | str) -> None:
+    """Stop sending to a user who has blocked the bot until they /start it again."""
+    user_id = str(user_id)
+    user = _get_users(context).get(user_id)
+    if not user or user_id in _get_blocked(context):
+        return
+    user['blocked_at'] = datetime.datetime.now(tz=datetime.UTC).isoformat()
+    _get_blocked(context).add(user_id)
+    logger.info('User %s has blocked the bot', user_id)
 
 
 def _get_meetings(context: te.ContextTypes.DEFAULT_TYPE) -> dict[str, list[models.CacheMeeting]]:
     return notnull(context.bot_data).setdefault('meetings', {})  # type: ignore[no-any-return]
 
 
+def _pair_key(left_id: str, right_id: str) -> tuple[str, str]:
+    return (left_id, right_id) if left_id <= right_id else (right_id, left_id)
+
+
+def _get_pairs(context: te.ContextTypes.DEFAULT_TYPE) -> dict[tuple[str, str], list[models.CacheMeeting]]:
+    """Index of both sides' meetings by unordered pair of users."""
+    indexes = _get_indexes(context)
+    if indexes.pairs is None:
+        indexes.pairs = {}
+        for user_id, meetings in _get_meetings(context).items():
+            for meeting in meetings:
+                indexes.pairs.setdefault(_pair_key(user_id, meeting.user_id), []).append(meeting)
+    return indexes.pairs
+
+
+def _unindex_meeting(context: te.ContextTypes.DEFAULT_TYPE, user_id: str, meeting: models.CacheMeeting) -> None:
+    key = _pair_key(user_id, meeting.user_id)
+    pairs = _get_pairs(context)
+    remaining = [pair_meeting for pair_meeting in pairs.get(key, []) if pair_meeting is not meeting]
+    if remaining:
+        pairs[key] = remaining
+    else:
+        pairs.pop(key, None)
+
+
+def get_pair_meetings(
+    context: te.ContextTypes.DEFAULT_TYPE, left_id: int | str, right_id: int | str
+) -> list[models.CacheMeeting]:
+    """Return meetings of both sides between two users."""
+    return _get_pairs(context).get(_pair_key(str(left_id), str(right_id)), [])
+
+
+def has_meeting(
+    context: te.ContextTypes.DEFAULT_TYPE,
+    left_id: int | str,
+    right_id: int | str,
+    statuses: set[models.MeetingStatus],
+) -> bool:
+    return any(meeting.status in statuses for meeting in get_pair_meetings(context, left_id, right_id))
+
+
+def iter_partner_pairs(context: te.ContextTypes.DEFAULT_TYPE) -> tp.Iterator[tuple[str, str]]:
+    """Yield every pair of users who have ever been paired, once per pair."""
+    for left_id, right_id in _get_pairs(context):
+        if left_id != right_id:
+            yield left_id, right_id
+
+
+def iter_history_pairs(context: te.ContextTypes.DEFAULT_TYPE, past: history.History) -> tp.Iterator[tuple[str, str]]:
+    """Yield pairs of the history as user ids, history users are matched by login and unknown ones are skipped."""
+    # /stop clears the user but keeps the login, such users are not paired anyway
+    enabled_ids = {username: user['user_id'] for username, user in _get_logins(context).items() if user.get('enabled')}
+    user_ids = [enabled_ids.get(username) for username in past.met.users]
+    for left_id, right_id in zip(past.left_ids, past.right_ids, strict=True):
+        left, right = user_ids[left_id], user_ids[right_id]
+        if left is not None and right is not None and left != right:
+            yield left, right
+
+
+def _get_waiting(context: te.ContextTypes.DEFAULT_TYPE) -> dict[str, models.CacheMeeting]:
+    """Users waiting for a partner after /more in order of arrival, mapped to their `more` meeting."""
+    indexes = _get_indexes(context)
+    if indexes.waiting is None:
+        waiting = [
+            (user_id, meeting)
+            for user_id, meetings in _get_meetings(context).items()
+            for meeting in meetings
+            if meeting.status == models.MeetingStatus.more
+        ]
+        waiting.sort(key=lambda item: item[1].waiting_since or '')
+        indexes.waiting = dict(waiting)
+    return indexes.waiting
+
+
+def _get_counters(context: te.ContextTypes.DEFAULT_TYPE) -> models.MeetingCounters:
+    """Counters of meetings by status, kept up to date by the functions which add, remove or update meetings."""
+    indexes = _get_indexes(context)
+    if indexes.counters is None:
+        indexes.counters = _count_meetings(context)
+    return indexes.counters
+
+
+def _count_meetings(context: te.ContextTypes.DEFAULT_TYPE) -> models.MeetingCounters:
+    counters = models.MeetingCounters()
+    for user_id, meetings in _get_meetings(context).items():
+        counter = counters.users[user_id] = collections.Counter(meeting.status for meeting in meetings)
+        for meeting in meetings:
+            if meeting.round_id is not None:
+                counters.rounds.setdefault(meeting.round_id, collections.Counter())[meeting.status] += 1
+        if get_user(context, user_id).get('enabled', False):
+            counters.total.update(counter)
+            counters.users_with_meetings += _has_meetings(counter)
+    return counters
+
+
+def _has_meetings(counter: collections.Counter[models.MeetingStatus]) -> bool:
+    return any(counter[status] > 0 for status in models.ALL_MEETINGS)
+
+
+def _count_meeting(
+    context: te.ContextTypes.DEFAULT_TYPE,
+    user_id: str,
+    status: models.MeetingStatus,
+    round_id: int | None,
+    delta: int,
+) -> None:
+    """Count a meeting of `user_id` in or out, it has to be called before the meeting itself is changed."""
+    counters = _get_counters(context)
+    if round_id is not None:
+        round_counter = counters.rounds.setdefault(round_id, collections.Counter())
+        round_counter[status] += delta
+        # a round whose meetings are all removed is dropped, as it is missing from counters counted from scratch
+        if not any(round_counter.values()):
+            del counters.rounds[round_id]
+    counter = counters.users.setdefault(user_id, collections.Counter())
+    if not get_user(context, user_id).get('enabled', False):
+        counter[status] += delta
+        return
+    had_meetings = _has_meetings(counter)
+    counter[status] += delta
+    counters.total[status] += delta
+    counters.users_with_meetings += _has_meetings(counter) - had_meetings
+
+
+def _count_user(context: te.ContextTypes.DEFAULT_TYPE, user_id: str, *, enabled: bool) -> None:
+    """Move the meetings of `user_id` in or out of the totals, it has to be called before the user is changed."""
+    counters = _get_counters(context)
+    counter = counters.users.get(user_id)
+    if not counter or get_user(context, user_id).get('enabled', False) == enabled:
+        return
+    if enabled:
+        counters.total.update(counter)
+    else:
+        counters.total.subtract(counter)
+    counters.users_with_meetings += _has_meetings(counter) if enabled else -_has_meetings(counter)
+
+
+def get_total_stats(context: te.ContextTypes.DEFAULT_TYPE) -> dict[models.MeetingStatus, int]:
+    """Return meetings of enabled users by status."""
+    total = _get_counters(context).total
+    return {status: total[status] for status in models.ALL_MEETINGS if total[status]}
+
+
+def count_users_with_meetings(context: te.ContextTypes.DEFAULT_TYPE) -> int:
+    return _get_counters(context).users_with_meetings
+
+
+def rebuild_counters(context: te.ContextTypes.DEFAULT_TYPE) -> int:
+    """Count the meetings from scratch and return the number of users whose counters were wrong."""
+    counters, rebuilt = _get_counters(context), _count_meetings(context)
+    user_ids = counters.users.keys() | rebuilt.users.keys()
+    empty: collections.Counter[models.MeetingStatus] = collections.Counter()
+    # `+` drops the zero counts left by removed meetings
+    mismatches = sum(+counters.users.get(user_id, empty) != +rebuilt.users.get(user_id, empty) for user_id in user_ids)
+    rounds_mismatch = {round_id: +counter for round_id, counter in counters.rounds.items()} != rebuilt.rounds
+    totals_mismatch = +counters.total != +rebuilt.total or counters.users_with_meetings != rebuilt.users_with_meetings
+    if mismatches or rounds_mismatch or totals_mismatch:
+        logger.warning('Meeting counters of %d users were out of sync, rebuilt them', mismatches)
+    _get_indexes(context).counters = rebuilt
+    return mismatches
+
+
+def _get_rounds(context: te.ContextTypes.DEFAULT_TYPE) -> dict[str, models.RoundInfo]:
+    return notnull(context.bot_data).setdefault('rounds', {})  # type: ignore[no-any-return]
+
+
+def add_round(context: te.ContextTypes.DEFAULT_TYPE, algorithm: str, new_round: pairing.Round) -> models.RoundInfo:
+    """Record a round made by `pairing.make_round`, its meetings are added with the returned `round_id`."""
+    rounds = _get_rounds(context)
+    round_id = max(map(int, rounds), default=0) + 1
+    round_info = rounds[str(round_id)] = models.RoundInfo(
+        round_id=round_id,
+        created_at=datetime.datetime.now(tz=datetime.UTC).isoformat(),
+        algorithm=algorithm,
+        pairs=len(new_round.pairs),
+        repeats=new_round.repeats,
+        unmatched=len(new_round.unmatched),
+    )
+    return round_info
+
+
+def count_rounds(context: te.ContextTypes.DEFAULT_TYPE) -> int:
+    return len(_get_rounds(context))
+
+
+def get_round_stats(context: te.ContextTypes.DEFAULT_TYPE, limit: int) -> list[models.RoundStats]:
+    """Return the stats of the last `limit` rounds from the counters, oldest first."""
+    rounds = _get_rounds(context)
+    counters = _get_counters(context).rounds
+    empty: collections.Counter[models.MeetingStatus] = collections.Counter()
+    result = []
+    for round_id in sorted(map(int, rounds))[-limit:]:
+        counter = counters.get(round_id, empty)
+        sides = counter.total()
+        result.append(
+            models.RoundStats(
+                round_id=round_id,
+                created_at=rounds[str(round_id)]['created_at'],
+                meetings=sides // 2,
+                done=counter[models.MeetingStatus.done] // 2,
+                nope=counter[models.MeetingStatus.nope] // 2,
+                pending=(sides - counter[models.MeetingStatus.done] - counter[models.MeetingStatus.nope]) // 2,
+                participants=sides,
+            )
+        )
+    return result
+
+
+def set_meeting_status(
+    context: te.ContextTypes.DEFAULT_TYPE,
+    user_id: int | str,
+    meeting: models.CacheMeeting,
+    status: models.MeetingStatus,
+) -> None:
+    """Set the status of a meeting of `user_id`, statuses must not be assigned directly to keep the counters."""
+    user_id = str(user_id)
+    _count_meeting(context, user_id, meeting.status, meeting.round_id, -1)
+    _count_meeting(context, user_id, status, meeting.round_id, 1)
+    meeting.status = status
+
+
+def lock_users(
+    context: te.ContextTypes.DEFAULT_TYPE, *user_ids: int | str
+) -> contextlib.AbstractAsyncContextManager[None]:
+    """
+    Hold the locks of `user_ids` while their meetings are read, something is awaited and they are changed.
+
+    The mutators here don't await, so each of them is atomic on the event loop, but a handler awaiting
+    in between has to hold the locks of both users of a pair. Idle locks are dropped.
+    """
+    user_locks = _user_locks.get(context.application)
+    if user_locks is None:
+        user_locks = _user_locks[context.application] = locks.KeyedLocks()
+    return user_locks.hold(*map(str, user_ids))
+
+
+def is_waiting(context: te.ContextTypes.DEFAULT_TYPE, user_id: int | str) -> bool:
+    return str(user_id) in _get_waiting(context)
+
+
+def match_waiting(
+    context: te.ContextTypes.DEFAULT_TYPE, user_id: int | str
+) -> tuple[models.CacheMeeting, str, models.CacheMeeting] | None:
+    """
+    Create a meeting with the longest waiting user who has never met this one, or start waiting.
+
+    Return the meeting of the user, the partner id and the meeting of the partner, or None if the user waits.
+    A user who is waiting already keeps their place. Nothing is awaited here, so concurrent /more handlers
+    can't take the same waiting user.
+    """
+    user_id = str(user_id)
+    waiting = _get_waiting(context)
+    if user_id in waiting:
+        return None
+    partner_id = next(
+        (
+            right_id
+            for right_id in waiting
+            if right_id != user_id
+            and get_user(context, right_id).get('enabled', False)
+            and not is_blocked(context, right_id)
+            and not has_meeting(context, user_id, right_id, models.MATCHED_MEETINGS)
+        ),
+        None,
+    )
+    if partner_id is None:
+        meeting = waiting[user_id] = add_meeting(context, user_id, user_id, status=models.MeetingStatus.more)
+        meeting.waiting_since = datetime.datetime.now(tz=datetime.UTC).isoformat()
+        return None
+    partner_meeting = waiting.pop(partner_id)
+    partner_meeting.waiting_since = None
+    set_meeting_partner(context, partner_id, partner_meeting, user_id)
+    set_meeting_status(context, partner_id, partner_meeting, models.MeetingStatus.created)
+    return add_meeting(context, user_id, partner_id), partner_id, partner_meeting
+
+
 def get_user_meetings(
     context: te.ContextTypes.DEFAULT_TYPE, user_id: int | str, statuses: set[models.MeetingStatus]
 ) -> list[models.CacheMeeting]:
     user_id = str(user_id)
-    if not get_user(context, user_id).get('enabled', False):
+    blocked = _get_blocked(context)
+    if user_id in blocked or not get_user(context, user_id).get('enabled', False):
         return []
     meetings = _get_meetings(context).setdefault(user_id, [])
-    return [meeting for meeting in meetings if meeting['status'] in statuses]
+    # meetings with users who have blocked the bot are hidden from their partners too
+    return [meeting for meeting in meetings if meeting.status in statuses and meeting.user_id not in blocked]
 
 
 def iter_meetings(
     context: te.ContextTypes.DEFAULT_TYPE, statuses: set[models.MeetingStatus]
 ) -> tp.Iterator[tuple[str, list[models.CacheMeeting]]]:
     all_meetings = _get_meetings(context)
+    blocked = _get_blocked(context)
     for user_id in all_meetings:
-        if not get_user(context, user_id).get('enabled', False):
+        if user_id in blocked or not get_user(context, user_id).get('enabled', False):
             yield (user_id, [])
+            continue
         yield (user_id, get_user_meetings(context, user_id, statuses))
 
 
 def iter_users(context: te.ContextTypes.DEFAULT_TYPE) -> tp.Iterator[tuple[str, models.TelegramUser]]:
     users = _get_users(context)
+    blocked = _get_blocked(context)
     for user_id, user in users.items():
-        if user.get('enabled', False):
+        if user.get('enabled', False) and user_id not in blocked:
             yield (user_id, user)
 
 
@@ -83,6 +434,7 @@ def register(context: te.ContextTypes.DEFAULT_TYPE, user_id: int, message: t.Mes
     user = get_user(context, str(user_id))
     username = notnull(notnull(message.from_user).username)
     chat_id = notnull(notnull(message.chat).id)
+    _count_user(context, str(user_id), enabled=True)
     user.update(
         models.TelegramUser(
             username=username,
@@ -92,6 +444,8 @@ def register(context: te.ContextTypes.DEFAULT_TYPE, user_id: int, message: t.Mes
             lang_code=user.get('lang_code', 'ru'),
         )
     )
+    user.pop('blocked_at', None)
+    _get_blocked(context).discard(str(user_id))
     _get_logins(context)[username] = user
 
 
@@ -99,16 +453,17 @@ def unregister(context: te.ContextTypes.DEFAULT_TYPE, user_id: int) -> None:
     user = get_user(context, str(user_id))
     if not user:
         return
+    _count_user(context, str(user_id), enabled=False)
     user.clear()  # type: ignore[attr-defined]
     user['enabled'] = False
+    _get_blocked(context).discard(str(user_id))
 
 
 def get_user_stats(context: te.ContextTypes.DEFAULT_TYPE, user_id: int) -> dict[models.MeetingStatus, int]:
-    result: dict[models.MeetingStatus, int] = collections.defaultdict(int)
-    user_meetings = get_user_meetings(context, str(user_id), statuses=models.ALL_MEETINGS)
-    for meeting in user_meetings:
-        result[meeting['status']] += 1
-    return result
+    counter = _get_counters(context).users.get(str(user_id))
+    if counter is None or not get_user(context, str(user_id)).get('enabled', False):
+        return {}
+    return {status: counter[status] for status in models.ALL_MEETINGS if counter[status]}
 
 
 def get_pending_meetings(context: te.ContextTypes.DEFAULT_TYPE, user_id: int | str) -> list[models.CacheMeeting]:
@@ -119,25 +474,96 @@ def get_all_meetings(context: te.ContextTypes.DEFAULT_TYPE, user_id: int) -> lis
     return get_user_meetings(context, str(user_id), models.ALL_MEETINGS)
 
 
+def get_meetings_page(
+    context: te.ContextTypes.DEFAULT_TYPE,
+    user_id: int | str,
+    statuses: set[models.MeetingStatus],
+    cursor: int,
+    limit: int,
+) -> models.MeetingsPage:
+    """
+    Return up to `limit` meetings with `statuses` from position `cursor` of the user's meetings.
+
+    Meetings of a user are kept in the order of creation, so a position is a cursor that survives
+    status updates. Only the meetings of the page and the ones skipped around it are looked at.
+    """
+    user_id = str(user_id)
+    blocked = _get_blocked(context)
+    if user_id in blocked or not get_user(context, user_id).get('enabled', False):
+        return models.MeetingsPage(meetings=[], prev_cursor=None, next_cursor=None)
+    meetings = _get_meetings(context).get(user_id, [])
+
+    def shown(idx: int) -> bool:
+        # like in `get_user_meetings`, meetings with users who have blocked the bot are hidden
+        return meetings[idx].status in statuses and meetings[idx].user_id not in blocked
+
+    cursor = min(max(cursor, 0), len(meetings))
+    after = filter(shown, range(cursor, len(meetings)))
+    positions = list(itertools.islice(after, limit + 1))
+    before = filter(shown, range(cursor - 1, -1, -1))
+    previous = list(itertools.islice(before, limit))
+    if not positions and previous:
+        # the cursor went stale after meetings were removed or closed, show the last page instead
+        return get_meetings_page(context, user_id, statuses, previous[-1], limit)
+    return models.MeetingsPage(
+        meetings=[meetings[idx] for idx in positions[:limit]],
+        prev_cursor=previous[-1] if previous else None,
+        next_cursor=positions[limit] if len(positions) > limit else None,
+    )
+
+
 def add_meeting(
     context: te.ContextTypes.DEFAULT_TYPE,
     left_id: int | str,
     right_id: int | str,
     status: models.MeetingStatus = models.MeetingStatus.created,
+    round_id: int | None = None,
 ) -> models.CacheMeeting:
-    left_id, right_id = str(left_id), str(right_id)
-    meetings = _get_meetings(context)
-    left_meeting = models.CacheMeeting(user_id=right_id, status=status)
+    left_id, right_id = sys.intern(str(left_id)), sys.intern(str(right_id))
+    meetings, pairs = _get_meetings(context), _get_pairs(context)
+    _count_meeting(context, left_id, status, round_id, 1)
+    left_meeting = models.CacheMeeting(user_id=right_id, status=status, round_id=round_id)
     meetings.setdefault(left_id, []).append(left_meeting)
+    pairs.setdefault(_pair_key(left_id, right_id), []).append(left_meeting)
     return left_meeting
 
 
+def add_pair(
+    context: te.ContextTypes.DEFAULT_TYPE,
+    left_id: int | str,
+    right_id: int | str,
+    status: models.MeetingStatus = models.MeetingStatus.created,
+    round_id: int | None = None,
+) -> tuple[models.CacheMeeting, models.CacheMeeting]:
+    return (
+        add_meeting(context, left_id, right_id, status, round_id),
+        add_meeting(context, right_id, left_id, status, round_id),
+    )
+
+
+def set_meeting_partner(
+    context: te.ContextTypes.DEFAULT_TYPE,
+    user_id: int | str,
+    meeting: models.CacheMeeting,
+    partner_id: int | str,
+) -> None:
+    user_id, partner_id = str(user_id), str(partner_id)
+    _unindex_meeting(context, user_id, meeting)
+    meeting.user_id = partner_id
+    _get_pairs(context).setdefault(_pair_key(user_id, partner_id), []).append(meeting)
+
+
 def remove_meetings(
     context: te.ContextTypes.DEFAULT_TYPE,
     user_id: int | str,
 ) -> None:
     user_id = str(user_id)
-    _get_meetings(context)[user_id] = []
+    meetings = _get_meetings(context)
+    for meeting in meetings.get(user_id, []):
+        _count_meeting(context, user_id, meeting.status, meeting.round_id, -1)
+        _unindex_meeting(context, user_id, meeting)
+    meetings[user_id] = []
+    _get_waiting(context).pop(user_id, None)
 
 
 def update_meeting_status(
@@ -145,14 +571,14 @@ def update_meeting_status(
 ) -> None:
     left_id, right_id = str(left_id), str(right_id)
     logger.info(f'Updating meeting status between {left_id=} and {right_id=}: {status}')  # noqa: G004
-    for meeting in get_pending_meetings(context, left_id):
-        if meeting['user_id'] == right_id:
-            meeting['status'] = status
-            logger.info('Done left')
-    for meeting in get_pending_meetings(context, right_id):
-        if meeting['user_id'] == left_id:
-            meeting['status'] = status
-            logger.info('Done right')
+    # meetings of disabled users are hidden, so their side stays as is
+    enabled_ids = {user_id for user_id in (left_id, right_id) if get_user(context, user_id).get('enabled', False)}
+    for meeting in get_pair_meetings(context, left_id, right_id):
+        # the partner of the owner is stored in the meeting, so the owner is the other user of the pair
+        owner_id = left_id if meeting.user_id == right_id else right_id
+        if owner_id in enabled_ids and meeting.status in models.PENDING_MEETINGS:
+            set_meeting_status(context, owner_id, meeting, status)
+            logger.info('Done %s', 'left' if owner_id == left_id else 'right')
 
 
 async def init_persistence(connection: sa.Connection) -> models.Data:
@@ -168,3 +594,238 @@ async def flush_persistence(session: tp.Any, data: models.Data) -> None:  # noqa
     )
     await session.execute(stmt)
     await session.commit()
+
+
+async def init_persistence_state(connection: sa.Connection) -> models.StoredState:
+    entries = await connection.execute(sa.select(models.PersistenceEntry))  # type: ignore[misc]
+    users = await connection.execute(sa.select(models.User))  # type: ignore[misc]
+    meeting = models.Meeting.__table__.c
+    meetings = await connection.execute(  # type: ignore[misc]
+        sa.select(models.Meeting).order_by(meeting.left_id, meeting.position)
+    )
+    rounds = await connection.execute(sa.select(models.Round))  # type: ignore[misc]
+    return models.StoredState(
+        data=await init_persistence(connection),
+        entries=list(entries.all()),
+        users=list(users.all()),
+        meetings=list(meetings.all()),
+        rounds=list(rounds.all()),
+    )
+
+
+async def flush_persistence_entries(
+    session: tp.Any,  # noqa: ANN401
+    upserts: dict[tuple[str, str], str],
+    deletes: set[tuple[str, str]],
+) -> None:
+    entry = models.PersistenceEntry
+    values = [{'namespace': namespace, 'key': key, 'value': value} for (namespace, key), value in upserts.items()]
+    for chunk in _chunked(values, ENTRIES_CHUNK_SIZE):
+        stmt = sqlite_upsert(entry).values(chunk)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[entry.namespace, entry.key],
+            set_={'value': stmt.excluded.value},
+        )
+        await session.execute(stmt)
+    for keys_chunk in _chunked(list(deletes), ENTRIES_CHUNK_SIZE):
+        await session.execute(sa.delete(entry).where(sa.tuple_(entry.namespace, entry.key).in_(keys_chunk)))
+
+
+async def flush_users(
+    session: tp.Any,  # noqa: ANN401
+    users: dict[str, models.TelegramUser],
+    deletes: set[str],
+) -> None:
+    values = [
+        {
+            'user_id': user_id,
+            'username': user.get('username'),
+            'chat_id': user.get('chat_id'),
+            'enabled': user.get('enabled'),
+            'lang_code': user.get('lang_code'),
+            'blocked_at': user.get('blocked_at'),
+        }
+        for user_id, user in users.items()
+    ]
+    for chunk in _chunked(values, ENTRIES_CHUNK_SIZE):
+        stmt = sqlite_upsert(models.User).values(chunk)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.User.user_id],
+            set_={
+                column: stmt.excluded[column]
+                for column in ('username', 'chat_id', 'enabled', 'lang_code', 'blocked_at')
+            },
+        )
+        await session.execute(stmt)
+    for ids_chunk in _chunked(list(deletes), ENTRIES_CHUNK_SIZE):
+        await session.execute(sa.delete(models.User).where(models.User.__table__.c.user_id.in_(ids_chunk)))
+
+
+async def flush_meetings(session: tp.Any, meetings: dict[str, list[models.CacheMeeting]]) -> None:  # noqa: ANN401
+    """Replace all meetings of the given users."""
+    for ids_chunk in _chunked(list(meetings), ENTRIES_CHUNK_SIZE):
+        await session.execute(sa.delete(models.Meeting).where(models.Meeting.__table__.c.left_id.in_(ids_chunk)))
+    values = [
+        {
+            'left_id': left_id,
+            'position': position,
+            'right_id': meeting.user_id,
+            'status': meeting.status,
+            'round_id': meeting.round_id,
+            'waiting_since': meeting.waiting_since,
+        }
+        for left_id, user_meetings in meetings.items()
+        for position, meeting in enumerate(user_meetings)
+    ]
+    for chunk in _chunked(values, ENTRIES_CHUNK_SIZE):
+        await session.execute(sa.insert(models.Meeting).values(chunk))
+
+
+async def flush_rounds(
+    session: tp.Any,  # noqa: ANN401
+    rounds: dict[str, models.RoundInfo],
+    deletes: set[str],
+) -> None:
+    values = list(rounds.values())
+    for chunk in _chunked(values, ENTRIES_CHUNK_SIZE):
+        stmt = sqlite_upsert(models.Round).values(chunk)
+        stmt = stmt.on_conflict_do_update(
+            index_elements=[models.Round.round_id],  # type: ignore[list-item]
+            set_={column: stmt.excluded[column] for column in models.RoundInfo.__annotations__ if column != 'round_id'},
+        )
+        await session.execute(stmt)
+    round_ids = [int(round_id) for round_id in deletes]
+    for ids_chunk in _chunked(round_ids, ENTRIES_CHUNK_SIZE):
+        await session.execute(sa.delete(models.Round).where(models.Round.__table__.c.round_id.in_(ids_chunk)))
+
+
+def users_from_rows(rows: list[models.User]) -> dict[str, models.TelegramUser]:
+    users: dict[str, models.TelegramUser] = {}
+    for row in rows:
+        user = {column: getattr(row, column) for column in models.TelegramUser.__annotations__}
+        users[row.user_id] = {key: value for key, value in user.items() if value is not None}  # type: ignore[assignment]
+    return users
+
+
+def meetings_from_rows(rows: list[models.Meeting]) -> dict[str, list[models.CacheMeeting]]:
+    meetings: dict[str, list[models.CacheMeeting]] = {}
+    for row in rows:
+        # every id is stored once however many meetings refer to it
+        meeting = models.CacheMeeting(
+            user_id=sys.intern(row.right_id),
+            status=models.MeetingStatus(row.status),
+            round_id=row.round_id,
+            waiting_since=row.waiting_since,
+        )
+        meetings.setdefault(sys.intern(row.left_id), []).append(meeting)
+    return meetings
+
+
+def meeting_to_json(meeting: models.CacheMeeting) -> dict[str, tp.Any]:
+    data: dict[str, tp.Any] = {'user_id': meeting.user_id, 'status': meeting.status}
+    if meeting.round_id is not None:
+        data['round_id'] = meeting.round_id
+    if meeting.waiting_since is not None:
+        data['waiting_since'] = meeting.waiting_since
+    return data
+
+
+def meetings_from_json(data: dict[str, list[dict[str, tp.Any]]]) -> dict[str, list[models.CacheMeeting]]:
+    """Load meetings saved as JSON by the single-row persistence."""
+    return {
+        sys.intern(left_id): [
+            models.CacheMeeting(
+                user_id=sys.intern(meeting['user_id']),
+                status=models.MeetingStatus(meeting['status']),
+                round_id=meeting.get('round_id'),
+                waiting_since=meeting.get('waiting_since'),
+            )
+            for meeting in meetings
+        ]
+        for left_id, meetings in data.items()
+    }
+
+
+def rounds_from_rows(rows: list[models.Round]) -> dict[str, models.RoundInfo]:
+    return {
+        str(row.round_id): {column: getattr(row, column) for column in models.RoundInfo.__annotations__}  # type: ignore[misc]
+        for row in rows
+    }
+
+
+async def enqueue_outbox(session: tp.Any, values: list[dict[str, tp.Any]]) -> int:  # noqa: ANN401
+    """Insert outbox messages, skipping the ones whose keys are already known. Return the number of new ones."""
+    enqueued = 0
+    for chunk in _chunked(values, ENTRIES_CHUNK_SIZE):
+        stmt = sqlite_upsert(models.OutboxMessage).values(chunk)
+        stmt = stmt.on_conflict_do_nothing(index_elements=[models.OutboxMessage.key])
+        result = await session.execute(stmt)
+        enqueued += result.rowcount
+    return enqueued
+
+
+async def fetch_outbox(session: tp.Any, limit: int) -> list[models.OutboxMessage]:  # noqa: ANN401
+    """Return the oldest pending message of every chat, so the messages of a chat are sent one by one in order."""
+    outbox = models.OutboxMessage
+    columns = outbox.__table__.c
+    heads = (
+        sa.select(sa.func.min(columns.id))
+        .where(columns.status == models.OutboxStatus.pending)
+        .group_by(columns.chat_id)
+        .scalar_subquery()
+    )
+    result = await session.scalars(sa.select(outbox).where(columns.id.in_(heads)).order_by(columns.id).limit(limit))
+    return list(result.all())
+
+
+async def mark_outbox(session: tp.Any, statuses: dict[int, models.OutboxStatus]) -> None:  # noqa: ANN401
+    ids_by_status: dict[models.OutboxStatus, list[int]] = collections.defaultdict(list)
+    for message_id, status in statuses.items():
+        ids_by_status[status].append(message_id)
+    columns = models.OutboxMessage.__table__.c
+    for status, ids in ids_by_status.items():
+        for chunk in _chunked(ids, ENTRIES_CHUNK_SIZE):
+            await session.execute(sa.update(models.OutboxMessage).where(columns.id.in_(chunk)).values(status=status))
+
+
+async def count_outbox_jobs(
+    session: tp.Any,  # noqa: ANN401
+    job_ids: list[str] | None = None,
+) -> dict[str, dict[models.OutboxStatus, int]]:
+    """Count messages of broadcast jobs by status, by default of the jobs which still have pending messages."""
+    columns = models.OutboxMessage.__table__.c
+    if job_ids is None:
+        pending = sa.select(columns.job_id).where(columns.status == models.OutboxStatus.pending)
+        job_ids = list((await session.scalars(pending.where(columns.job_id.is_not(None)).distinct())).all())
+    counts: dict[str, dict[models.OutboxStatus, int]] = {job_id: {} for job_id in job_ids}
+    for chunk in _chunked(job_ids, ENTRIES_CHUNK_SIZE):
+        stmt = (
+            sa.select(columns.job_id, columns.status, sa.func.count())
+            .where(columns.job_id.in_(chunk))
+            .group_by(columns.job_id, columns.status)
+        )
+        for job_id, status, count in await session.execute(stmt):
+            counts[job_id][models.OutboxStatus(status)] = count
+    return counts
+
+
+async def count_pending_outbox(session: tp.Any) -> int:  # noqa: ANN401
+    stmt = sa.select(sa.func.count()).where(models.OutboxMessage.__table__.c.status == models.OutboxStatus.pending)
+    return tp.cast(int, await session.scalar(stmt))
+
+
+async def purge_outbox(session: tp.Any, before: datetime.datetime) -> int:  # noqa: ANN401
+    """Delete messages which are not pending anymore and were created before `before`."""
+    columns = models.OutboxMessage.__table__.c
+    result = await session.execute(
+        sa.delete(models.OutboxMessage).where(
+            columns.status != models.OutboxStatus.pending,
+            columns.created_at < before,
+        )
+    )
+    return tp.cast(int, result.rowcount)
+
+
+def _chunked(values: list[_T], size: int) -> tp.Iterator[list[_T]]:
+    for idx in range(0, len(values), size):
+        yield values[idx : idx + size]
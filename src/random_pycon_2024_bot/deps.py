@@ -6,10 +6,14 @@ import sqlalchemy as sa
 import telegram as t
 import telegram.ext as te
 
+from random_pycon_2024_bot import broadcast
+from random_pycon_2024_bot import codec
 from random_pycon_2024_bot import db
 from random_pycon_2024_bot import handlers
+from random_pycon_2024_bot import history
 from random_pycon_2024_bot import models
 from random_pycon_2024_bot import persistence
+from random_pycon_2024_bot import updates
 from random_pycon_2024_bot.settings import settings
 
 logger = logging.getLogger(__name__)
@@ -21,39 +25,67 @@ async def get_tg_app(app: ls.Litestar) -> None:
     tg_app = getattr(app.state, 'tg_app', None)
     if tg_app is None:
         async with app.state.db_engine.begin() as conn:
-            data = await db.init_persistence(conn)
-            logger.info(data)
-        tg_app = create_tg_app(db_engine=app.state.db_engine, data=data)
+            state = await db.init_persistence_state(conn)
+            logger.info(
+                'Loaded %d persistence entries, %d users, %d meetings and %d rounds',
+                len(state.entries),
+                len(state.users),
+                len(state.meetings),
+                len(state.rounds),
+            )
+        tg_app = create_tg_app(db_engine=app.state.db_engine, state=state)
         app.state.tg_app = tg_app
 
     await tg_app.bot.set_webhook(url=f'{settings.url}/telegram', allowed_updates=t.Update.ALL_TYPES)
 
     await tg_app.initialize()
     await tg_app.start()
+    broadcast.get_broadcaster(tg_app).start_dispatcher(tg_app.bot)
 
 
 async def close_tg_app(app: ls.Litestar) -> None:
     tg_app = getattr(app.state, 'tg_app', None)
     if tg_app is None:
         return
+    await broadcast.get_broadcaster(tg_app).stop_dispatcher()
     await tg_app.stop()
     await tg_app.shutdown()
 
 
-def create_tg_app(db_engine: sa.Engine, data: models.Data) -> te.Application:  # type: ignore[type-arg]
+def create_tg_app(db_engine: sa.Engine, state: models.StoredState) -> te.Application:  # type: ignore[type-arg]
     context_types = te.ContextTypes(context=handlers.CustomContext)
-    persistence_db = persistence.SqlitePersistence(db_engine, data=data)
+    persistence_db: persistence.SqlitePersistence
+    if settings.incremental_persistence:
+        persistence_db = persistence.IncrementalSqlitePersistence(
+            db_engine, state=state, flush_interval=settings.persistence_flush_interval
+        )
+    else:
+        persistence_db = persistence.SqlitePersistence(
+            db_engine, data=state.data, flush_interval=settings.persistence_flush_interval
+        )
     application = (
         te.ApplicationBuilder()
         .token(settings.token)
         .updater(None)
         .context_types(context_types)
         .persistence(persistence_db)
+        .update_queue(
+            updates.UpdateQueue(
+                settings.update_queue_size, settings.max_pending_updates, policy=settings.update_queue_policy
+            )
+        )
+        .concurrent_updates(
+            updates.UserOrderedUpdateProcessor(settings.update_concurrency, settings.max_pending_updates)
+        )
         .build()
     )  # TODO(serjflint): pass app and DI to handlers
+    broadcast.setup(application, db_engine)
+    if settings.history_dir is not None:
+        history.setup(application, history.load_history(history.iter_history_files(settings.history_dir)))
 
     echo_handler = te.MessageHandler(te.filters.TEXT & (~te.filters.COMMAND), handlers.echo)
     inline_caps_handler = te.InlineQueryHandler(handlers.inline_caps)
+    who_page_handler = te.CallbackQueryHandler(handlers.who_page, pattern=handlers.WHO_PAGE_PATTERN)
 
     webhook_handler = te.TypeHandler(type=models.WebhookUpdate, callback=handlers.webhook_update)
     unknown_handler = te.MessageHandler(te.filters.COMMAND, handlers.unknown)
@@ -63,6 +95,7 @@ def create_tg_app(db_engine: sa.Engine, data: models.Data) -> te.Application:  #
 
     application.add_handler(echo_handler)  # type: ignore[arg-type]
     application.add_handler(inline_caps_handler)  # type: ignore[arg-type]
+    application.add_handler(who_page_handler)  # type: ignore[arg-type]
     application.add_handler(webhook_handler)
     application.add_handler(unknown_handler)
 
@@ -77,5 +110,8 @@ async def init_db(app: ls.Litestar) -> None:
         await conn.run_sync(models.Base.metadata.create_all)
 
 
-db_config = plugins.SQLAlchemyAsyncConfig(connection_string=PERSISTENCE_DB_URL)
+db_config = plugins.SQLAlchemyAsyncConfig(
+    connection_string=PERSISTENCE_DB_URL,
+    engine_config=plugins.EngineConfig(json_serializer=codec.dumps, json_deserializer=codec.loads),
+)
 db_plugin = plugins.SQLAlchemyPlugin(config=db_config)
@@ -4,3 +4,11 @@ class AppError(Exception):
 
 class UnknownLoginError(AppError):
     pass
+
+
+class HistoryFormatError(AppError):
+    pass
+
+
+class TemplateError(AppError):
+    pass
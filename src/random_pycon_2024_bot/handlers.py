@@ -1,23 +1,26 @@
-import contextlib
+import dataclasses
 import functools
 import html
+import itertools
 import json
 import logging
-import textwrap
 import traceback
 import typing as tp
 import uuid
 
 import telegram as t
 import telegram.constants as tc
-import telegram.error
 import telegram.ext as te
 from telegram.helpers import escape_markdown
 
+from random_pycon_2024_bot import broadcast
 from random_pycon_2024_bot import db
 from random_pycon_2024_bot import exceptions
+from random_pycon_2024_bot import history
 from random_pycon_2024_bot import messages
 from random_pycon_2024_bot import models
+from random_pycon_2024_bot import pairing
+from random_pycon_2024_bot import templates
 from random_pycon_2024_bot import utils
 from random_pycon_2024_bot.settings import settings
 from random_pycon_2024_bot.utils import get_command_value
@@ -90,7 +93,7 @@ def markdown_handler(handler_command: tp.Callable) -> tp.Callable:  # type: igno
         else:
             response_text, kwargs = res, {}
         lang_code = db.get_lang_code(context, user_id)
-        await message.reply_markdown(text=utils.get_message(response_text, lang_code).format(**kwargs))
+        await message.reply_markdown(text=templates.render(response_text, lang_code, **kwargs))
 
     return wrapper
 
@@ -117,7 +120,8 @@ async def start_command(context: TContext, message: t.Message, user_id: int, **_
 @Command('stop')
 @markdown_handler
 async def stop_command(context: TContext, user_id: int, **_kwargs: tp.Any) -> str:
-    db.unregister(context, user_id)
+    async with db.lock_users(context, user_id):
+        db.unregister(context, user_id)
     return messages.STOP_SUCCESS_MESSAGE
 
 
@@ -132,53 +136,71 @@ async def stats_command(context: TContext, user_id: int, **_kwargs: tp.Any) -> t
     return messages.STATS_MESSAGE, kwargs
 
 
+WHO_PAGE_PATTERN = r'^(who|all):\d+$'
+
+
+def render_who_page(
+    context: TContext, user_id: int, *, is_all: bool, cursor: int
+) -> tuple[str, t.InlineKeyboardMarkup | None]:
+    """Render a page of /who or /all, the buttons carry the cursors of the neighbouring pages."""
+    statuses = models.ALL_MEETINGS if is_all else models.PENDING_MEETINGS
+    page = db.get_meetings_page(context, user_id, statuses, cursor, settings.who_page_size)
+    lang_code = db.get_lang_code(context, user_id)
+    get_template = functools.partial(templates.get_template, lang_code=lang_code)
+
+    if not page.meetings:
+        no_meetings = messages.MESSAGE_NO_NEW_MEETINGS if not is_all else messages.MESSAGE_NO_MEETINGS_AT_ALL
+        return get_template(no_meetings).text, None
+    greetings = get_template(messages.ALL_WAITING_MEETINGS if not is_all else messages.ALL_YOUR_MEETINGS).text
+    record, mention = get_template(messages.WHO_MESSAGE_RECORD), get_template(messages.TELEGRAM_MENTION)
+    actions, status_texts = templates.get_who_actions(lang_code), templates.get_status_texts(lang_code)
+
+    def render_record(meeting: models.CacheMeeting) -> str:
+        login = db.get_user(context, meeting.user_id)['username']
+        return record.render(
+            telegrams=mention.render(tg_login=login),
+            status=status_texts[meeting.status],
+            interests='Python',
+            additional=(
+                actions.render(login=escape_markdown(login)) if meeting.status not in templates.CLOSED_STATUSES else ''
+            ),
+        )
+
+    records = '\n\n\n'.join(map(render_record, page.meetings))
+    response_text = get_template(messages.WHO_FULL_MESSAGE).render(greetings=greetings, records=records)
+
+    command = 'all' if is_all else 'who'
+    buttons = []
+    if page.prev_cursor is not None:
+        label = get_template(messages.WHO_PREV_PAGE_LABEL).text
+        buttons.append(t.InlineKeyboardButton(label, callback_data=f'{command}:{page.prev_cursor}'))
+    if page.next_cursor is not None:
+        label = get_template(messages.WHO_NEXT_PAGE_LABEL).text
+        buttons.append(t.InlineKeyboardButton(label, callback_data=f'{command}:{page.next_cursor}'))
+    return response_text, t.InlineKeyboardMarkup([buttons]) if buttons else None
+
+
 @Command('who')
 @Command('all')
 @default_handler
 async def who_command(context: TContext, message: t.Message, user_id: int, **_kwargs: tp.Any) -> None:
     is_all = get_command_value(message) == 'all'
-    meetings = db.get_pending_meetings(context, user_id) if not is_all else db.get_all_meetings(context, user_id)
-    lang_code = db.get_lang_code(context, user_id)
-    get_message = functools.partial(utils.get_message, lang_code=lang_code)
+    text, reply_markup = render_who_page(context, user_id, is_all=is_all, cursor=0)
+    await message.reply_markdown(text=text, reply_markup=reply_markup)
 
-    if not meetings:
-        await message.reply_markdown(
-            text=get_message(messages.MESSAGE_NO_NEW_MEETINGS if not is_all else messages.MESSAGE_NO_MEETINGS_AT_ALL)
-        )
-        return
-    greetings = get_message(messages.ALL_WAITING_MEETINGS if not is_all else messages.ALL_YOUR_MEETINGS)
 
-    def get_status_text(status: models.MeetingStatus) -> str:
-        choices = utils.get_multi_message(messages.MEETING_STATUS_TEXTS, lang_code=lang_code)
-        indices = list(models.MeetingStatus)
-        return choices[max(indices.index(status) - 3, 0)]
-
-    @functools.cache
-    def get_login(user_id: str) -> str:
-        return db.get_user(context, user_id)['username']
-
-    records = [
-        get_message(messages.WHO_MESSAGE_RECORD).format(
-            telegrams=get_message(messages.TELEGRAM_MENTION).format(tg_login=get_login(meeting['user_id'])),
-            status=get_status_text(meeting['status']),
-            interests='Python',
-            additional=(
-                escape_markdown(
-                    textwrap.dedent(f"""
-                    {get_message(messages.MEETING_ALREADY_DONE_LABEL)}: /pass_{get_login(meeting['user_id'])}
-                    {get_message(messages.MEETING_IS_DECLINED_LABEL)}: /deny_{get_login(meeting['user_id'])}
-                    """)
-                )
-                if meeting['status'] not in {models.MeetingStatus.done, models.MeetingStatus.nope}
-                else ''
-            ),
-        )
-        for meeting in meetings
-    ]
-    response_text = get_message(messages.WHO_FULL_MESSAGE).format(
-        greetings=greetings, records='\n\n\n'.join(records[:10])
-    )
-    await message.reply_markdown(text=response_text)
+async def who_page(update: t.Update, context: TContext) -> None:
+    """Replace the /who or /all message with the page of the pressed button."""
+    query = utils.notnull(update.callback_query)
+    command, cursor = utils.notnull(query.data).split(':')
+    text, reply_markup = render_who_page(context, query.from_user.id, is_all=command == 'all', cursor=int(cursor))
+    await query.answer()
+    try:
+        await query.edit_message_text(text=text, parse_mode=tc.ParseMode.MARKDOWN, reply_markup=reply_markup)
+    except t.error.BadRequest as exc:
+        # pressing a button of an outdated message can render the same page again
+        if 'not modified' not in exc.message:
+            raise
 
 
 @Command('more')
@@ -186,32 +208,22 @@ async def who_command(context: TContext, message: t.Message, user_id: int, **_kw
 @markdown_handler
 async def more_command(context: TContext, message: t.Message, user_id: int, **_kwargs: tp.Any) -> str:
     left_id = str(user_id)
-    more_meetings = db.get_user_meetings(context, left_id, statuses={models.MeetingStatus.more})
-    logger.info('Existing more meetings %s', more_meetings)
-    if more_meetings:
+    if db.is_waiting(context, left_id):
         return messages.CANCEL_SUCCESS_MESSAGE
-    left_meeting = db.add_meeting(context, left_id, left_id, status=models.MeetingStatus.more)
-    for right_id, meetings in db.iter_meetings(context, statuses=models.PENDING_MEETINGS):
-        if right_id == left_id:
-            continue
-        common_meetings = [meeting for meeting in meetings if meeting['user_id'] == left_id]
-        if common_meetings:
-            return messages.MEETING_ALREADY_DONE_LABEL
-        more_meetings = db.get_user_meetings(context, right_id, statuses={models.MeetingStatus.more})
-        if not more_meetings:
-            continue
-        right_meeting = more_meetings[0]
-        break
-    else:
+    match = db.match_waiting(context, left_id)
+    if match is None:
+        logger.info('User %s is waiting for a partner', left_id)
         return messages.CANCEL_SUCCESS_MESSAGE
-    left_meeting['user_id'] = str(right_id)
-    right_meeting['user_id'] = str(left_id)
-    left_meeting['status'] = models.MeetingStatus.created
-    right_meeting['status'] = models.MeetingStatus.created
-    await send_meeting(context, left_id)
-    await send_meeting(context, right_id)
-    left_meeting['status'] = models.MeetingStatus.showed
-    right_meeting['status'] = models.MeetingStatus.showed
+    left_meeting, right_id, right_meeting = match
+    async with db.lock_users(context, left_id, right_id):
+        # /newround or a status update could get to the new meeting while the locks were awaited
+        if left_meeting.status != models.MeetingStatus.created:
+            return messages.CANCEL_SUCCESS_MESSAGE
+        await send_meeting(context, left_id)
+        await send_meeting(context, right_id)
+        db.set_meeting_status(context, left_id, left_meeting, models.MeetingStatus.showed)
+        if right_meeting.status == models.MeetingStatus.created:
+            db.set_meeting_status(context, right_id, right_meeting, models.MeetingStatus.showed)
     return messages.CANCEL_SUCCESS_MESSAGE
 
 
@@ -219,11 +231,9 @@ async def more_command(context: TContext, message: t.Message, user_id: int, **_k
 @admin_handler
 async def add_command(context: TContext, message: t.Message, **_kwargs: tp.Any) -> str:
     left, right = utils.get_mentions(message)
-    db.add_meeting(
-        context,
-        left_id=db.get_login(context, left)['user_id'],
-        right_id=db.get_login(context, right)['user_id'],
-    )
+    left_id, right_id = db.get_login(context, left)['user_id'], db.get_login(context, right)['user_id']
+    async with db.lock_users(context, left_id, right_id):
+        db.add_meeting(context, left_id=left_id, right_id=right_id)
 
     return messages.CANCEL_SUCCESS_MESSAGE
 
@@ -233,7 +243,8 @@ async def add_command(context: TContext, message: t.Message, **_kwargs: tp.Any)
 async def remove_command(context: TContext, message: t.Message, **_kwargs: tp.Any) -> str:
     username, *_ = utils.get_mentions(message)
     user_id = db.get_login(context, username)['user_id']
-    db.remove_meetings(context, user_id=user_id)
+    async with db.lock_users(context, user_id):
+        db.remove_meetings(context, user_id=user_id)
     logger.info('Now meetings are %s', db.get_user_meetings(context, user_id, models.ALL_MEETINGS))
 
     return messages.CANCEL_SUCCESS_MESSAGE
@@ -241,85 +252,146 @@ async def remove_command(context: TContext, message: t.Message, **_kwargs: tp.An
 
 @Command('leaderboard')
 @admin_handler
-async def leaderboard_command(context: TContext, **_kwargs: tp.Any) -> tuple[str, dict[str, int]]:
-    users_with_meetings = 0
-    all_meetings = 0
-    passed_meetings, denied_meetings, notyet_meetings = 0, 0, 0
-    for _, meetings in db.iter_meetings(context, statuses=models.ALL_MEETINGS):
-        if len(meetings) > 0:
-            users_with_meetings += 1
-            all_meetings += len(meetings)
-        for meeting in meetings:
-            if meeting['status'] == models.MeetingStatus.done:
-                passed_meetings += 1
-            elif meeting['status'] == models.MeetingStatus.nope:
-                denied_meetings += 1
-            else:
-                notyet_meetings += 1
-
+async def leaderboard_command(context: TContext, user_id: int, **_kwargs: tp.Any) -> tuple[str, dict[str, tp.Any]]:
+    stats = db.get_total_stats(context)
+    passed_meetings = stats.get(models.MeetingStatus.done, 0)
+    denied_meetings = stats.get(models.MeetingStatus.nope, 0)
+    round_template = templates.get_template(messages.LEADER_BOARD_ROUND, db.get_lang_code(context, user_id))
+    rounds = '\n'.join(
+        round_template.render(**dataclasses.asdict(round_stats))
+        for round_stats in db.get_round_stats(context, settings.leaderboard_rounds)
+    )
     kwargs = {
-        'all_rounds': -1,
-        'all_auth': users_with_meetings,
+        'all_rounds': db.count_rounds(context),
+        'rounds': rounds,
+        'all_auth': db.count_users_with_meetings(context),
         'all_members': db.count_enabled_users(context),
-        'all_meetings': all_meetings // 2,
+        'all_blocked': db.count_blocked_users(context),
+        'all_meetings': sum(stats.values()) // 2,
         'all_passed': passed_meetings,
         'all_denied': denied_meetings,
-        'all_notyet': notyet_meetings,
+        'all_notyet': sum(stats.values()) - passed_meetings - denied_meetings,
     }
 
     return messages.LEADER_BOARD_MESSAGE, kwargs
 
 
-async def send_meeting(
+@Command('recount')
+@admin_handler
+async def recount_command(context: TContext, **_kwargs: tp.Any) -> tuple[str, dict[str, int]]:
+    return messages.COUNTERS_REBUILT_MESSAGE, {'mismatches': db.rebuild_counters(context)}
+
+
+def meeting_notification(
     context: TContext,
     user_id: int | str,
-    message: str = messages.TELL_PEOPLE_THEY_HAVE_NEW_MEETINGS,
-    **_kwargs: tp.Any,
-) -> None:
+    message: str,
+    key: str,
+) -> broadcast.OutboxItem | None:
     user_id = str(user_id)
     user = db.get_user(context, user_id)
     logger.info(user)
-    if not user['enabled']:
-        return
+    if not user['enabled'] or db.is_blocked(context, user_id):
+        return None
     lang_code = db.get_lang_code(context, user_id)
-    await context.bot.send_message(chat_id=user_id, text=utils.get_message(message, lang_code))
+    return broadcast.OutboxItem(chat_id=user_id, text=templates.get_template(message, lang_code).text, key=key)
+
+
+async def send_meeting(
+    context: TContext,
+    user_id: int | str,
+    message: str = messages.TELL_PEOPLE_THEY_HAVE_NEW_MEETINGS,
+    key: str | None = None,
+    **_kwargs: tp.Any,
+) -> None:
+    item = meeting_notification(context, user_id, message, key=key or uuid.uuid4().hex)
+    if item is not None:
+        await broadcast.get_broadcaster(context.application).enqueue([item])
+
+
+async def start_broadcast(
+    context: TContext,
+    keys: dict[str, str],
+    message: str = messages.TELL_PEOPLE_THEY_HAVE_NEW_MEETINGS,
+) -> tuple[str, dict[str, tp.Any]]:
+    """Enqueue `message` for the users in `keys`, which are the idempotency keys of their messages."""
+    items = [meeting_notification(context, user_id, message, key) for user_id, key in keys.items()]
+    job = await broadcast.get_broadcaster(context.application).start(item for item in items if item is not None)
+    return messages.BROADCAST_STARTED_MESSAGE, {'job_id': job.job_id, 'total': job.total}
 
 
 @Command('newround')
 @admin_handler
-async def newround_command(context: TContext, **_kwargs: tp.Any) -> str:
-    for left_id, left_meetings in db.iter_meetings(context, statuses={models.MeetingStatus.created}):
-        for left in left_meetings:
-            right_id = left['user_id']
+async def newround_command(context: TContext, **_kwargs: tp.Any) -> tuple[str, dict[str, tp.Any]]:
+    user_ids: list[str] = []
+    # meetings are collected first, they can change while the locks of a pair are awaited
+    created = [
+        (left_id, left)
+        for left_id, left_meetings in db.iter_meetings(context, statuses={models.MeetingStatus.created})
+        for left in left_meetings
+    ]
+    for left_id, left in created:
+        right_id = left.user_id
+        async with db.lock_users(context, left_id, right_id):
+            # both sides of a pair are collected, the second one is already shown
+            if left.status != models.MeetingStatus.created:
+                continue
             right_meetings = db.get_user_meetings(context, right_id, statuses={models.MeetingStatus.created})
-            right = next(right for right in right_meetings if right['user_id'] == left_id)
-            await send_meeting(context, left_id)
-            await send_meeting(context, right_id)
-            right['status'] = models.MeetingStatus.showed
-            left['status'] = models.MeetingStatus.showed
+            right = next(right for right in right_meetings if right.user_id == left_id)
+            user_ids += [left_id, right_id]
+            db.set_meeting_status(context, right_id, right, models.MeetingStatus.showed)
+            db.set_meeting_status(context, left_id, left, models.MeetingStatus.showed)
+
+    # the number of meetings tells rounds apart, so running /newround again after a restart sends nothing twice
+    keys = {
+        user_id: f'newround:{user_id}:{len(db.get_user_meetings(context, user_id, models.MATCHED_MEETINGS))}'
+        for user_id in user_ids
+    }
+    return await start_broadcast(context, keys)
 
-    return messages.CANCEL_SUCCESS_MESSAGE
+
+@Command('makeround')
+@admin_handler
+async def makeround_command(context: TContext, message: t.Message, **_kwargs: tp.Any) -> tuple[str, dict[str, tp.Any]]:
+    args = utils.get_command_args(message, command='makeround')
+    algorithm = args[0] if args else pairing.DEFAULT_ALGORITHM
+    if algorithm not in pairing.ALGORITHMS:
+        return messages.UNKNOWN_ALGORITHM_MESSAGE, {'algorithms': ', '.join(pairing.ALGORITHMS)}
+    users = [user_id for user_id, _ in db.iter_users(context)]
+    pairs = db.iter_partner_pairs(context)
+    past = history.get_history(context.application)
+    if past is not None:
+        pairs = itertools.chain(pairs, db.iter_history_pairs(context, past))
+    met = pairing.MetMatrix.from_pairs(pairs)
+    new_round = pairing.make_round(users, met, algorithm=algorithm)
+    round_info = db.add_round(context, algorithm, new_round)
+    for left_id, right_id in new_round.pairs:
+        db.add_pair(context, left_id, right_id, round_id=round_info['round_id'])
+    logger.info('Created round %d of %d meetings with %s', round_info['round_id'], len(new_round.pairs), algorithm)
+    kwargs = {
+        'round_id': round_info['round_id'],
+        'pairs': len(new_round.pairs),
+        'repeats': new_round.repeats,
+        'unmatched': len(new_round.unmatched),
+    }
+    return messages.ROUND_CREATED_MESSAGE, kwargs
 
 
 @Command('notifyall')
 @admin_handler
-async def notifyall_command(context: TContext, **_kwargs: tp.Any) -> str:
-    for user_id, meetings in db.iter_meetings(context, statuses=models.PENDING_MEETINGS):
-        if not meetings:
-            continue
-        await send_meeting(context, user_id)
-
-    return messages.CANCEL_SUCCESS_MESSAGE
+async def notifyall_command(context: TContext, **_kwargs: tp.Any) -> tuple[str, dict[str, tp.Any]]:
+    run_id = uuid.uuid4().hex
+    pending_meetings = db.iter_meetings(context, statuses=models.PENDING_MEETINGS)
+    keys = {user_id: f'notifyall:{run_id}:{user_id}' for user_id, meetings in pending_meetings if meetings}
+    return await start_broadcast(context, keys)
 
 
 @Command('callback')
 @admin_handler
-async def callback_command(context: TContext, **_kwargs: tp.Any) -> str:
-    for user_id, _ in db.iter_users(context):
-        with contextlib.suppress(telegram.error.Forbidden):
-            await send_meeting(context, user_id, message=messages.TELL_PEOPLE_THEY_HAVE_MASTERCLASS)
-
-    return messages.CANCEL_SUCCESS_MESSAGE
+async def callback_command(context: TContext, **_kwargs: tp.Any) -> tuple[str, dict[str, tp.Any]]:
+    run_id = uuid.uuid4().hex
+    keys = {user_id: f'callback:{run_id}:{user_id}' for user_id, _ in db.iter_users(context)}
+    return await start_broadcast(context, keys, message=messages.TELL_PEOPLE_THEY_HAVE_MASTERCLASS)
 
 
 @Command('pass', te.PrefixHandler)
@@ -331,7 +403,8 @@ async def pass_command(context: TContext, message: t.Message, user_id: int, **_k
         return messages.HELP_UPDATE_STATUS_MESSAGE, {'command': 'pass'}
     right_login = args[0]
     left_id, right_id = user_id, db.get_login(context, right_login)['user_id']
-    db.update_meeting_status(context, left_id, right_id, status=models.MeetingStatus.done)
+    async with db.lock_users(context, left_id, right_id):
+        db.update_meeting_status(context, left_id, right_id, status=models.MeetingStatus.done)
     return messages.STATUS_UPDATE_MESSAGE
 
 
@@ -343,7 +416,8 @@ async def reset_command(context: TContext, message: t.Message, user_id: int, **_
         return messages.HELP_UPDATE_STATUS_MESSAGE
     right_login = args[0]
     left_id, right_id = user_id, db.get_login(context, right_login)['user_id']
-    db.update_meeting_status(context, left_id, right_id, status=models.MeetingStatus.yet)
+    async with db.lock_users(context, left_id, right_id):
+        db.update_meeting_status(context, left_id, right_id, status=models.MeetingStatus.yet)
     return messages.STATUS_UPDATE_MESSAGE
 
 
@@ -355,7 +429,8 @@ async def deny_command(context: TContext, message: t.Message, user_id: int, **_k
         return messages.HELP_UPDATE_STATUS_MESSAGE
     right_login = args[0]
     left_id, right_id = user_id, db.get_login(context, right_login)['user_id']
-    db.update_meeting_status(context, left_id, right_id, status=models.MeetingStatus.nope)
+    async with db.lock_users(context, left_id, right_id):
+        db.update_meeting_status(context, left_id, right_id, status=models.MeetingStatus.nope)
     return messages.STATUS_UPDATE_MESSAGE
 
 
@@ -455,4 +530,10 @@ async def error_handler(update: object, context: TContext) -> None:
     )
 
     # Finally, send the message
-    await context.bot.send_message(chat_id=settings.admin_chat_id, text=message, parse_mode=tc.ParseMode.HTML)
+    report = broadcast.OutboxItem(
+        chat_id=str(settings.admin_chat_id),
+        text=message,
+        key=uuid.uuid4().hex,
+        parse_mode=tc.ParseMode.HTML,
+    )
+    await broadcast.get_broadcaster(context.application).enqueue([report])
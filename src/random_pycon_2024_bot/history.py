@@ -0,0 +1,339 @@
+import array
+import collections
+import concurrent.futures
+import dataclasses
+import logging
+import mmap
+import os
+import pathlib
+import struct
+import sys
+import time
+import typing as tp
+import weakref
+
+import telegram.ext as te
+
+from random_pycon_2024_bot import exceptions
+from random_pycon_2024_bot import models
+from random_pycon_2024_bot import pairing
+
+logger = logging.getLogger(__name__)
+
+CHUNK_SIZE = 1 << 20
+STATUSES: list[models.MeetingStatus] = list(models.MeetingStatus)
+STATUS_CODES = {status.encode(): code for code, status in enumerate(STATUSES)}
+DEFAULT_STATUS = models.MeetingStatus.done
+
+# binary history: header, usernames separated by newlines and padded to 8 bytes,
+# uint64 offsets of the rounds in meetings, int32 (left, right) pairs, uint8 status codes
+BINARY_MAGIC = b'RCHB'
+BINARY_VERSION = 1
+BINARY_HEADER = struct.Struct('<4sIIIQ')  # magic, version, users, rounds, size of usernames
+
+_histories: 'weakref.WeakKeyDictionary[te.Application, History]' = weakref.WeakKeyDictionary()  # type: ignore[type-arg]
+
+
+@dataclasses.dataclass
+class RoundFile:
+    """A parsed round file, user ids are local to the file and index `users`."""
+
+    users: list[str]
+    left_ids: array.array[int]
+    right_ids: array.array[int]
+    statuses: array.array[int]
+
+
+class History:
+    """
+    Meetings of past rounds stored column-wise: round index, interned user ids and status codes.
+
+    Users are interned by `met`, which also collects who has met whom, so the history can be passed
+    to `pairing.make_round` as is. A meeting takes 11 bytes in the columns.
+    """
+
+    def __init__(self, met: pairing.MetMatrix | None = None) -> None:
+        self.met = met if met is not None else pairing.MetMatrix()
+        self.rounds = array.array('H')
+        self.left_ids = array.array('I')
+        self.right_ids = array.array('I')
+        self.statuses = array.array('B')
+
+    def __len__(self) -> int:
+        """Return the number of meetings."""
+        return len(self.rounds)
+
+    def add(self, round_idx: int, left_id: int, right_id: int, status_code: int) -> None:
+        self.rounds.append(round_idx)
+        self.left_ids.append(left_id)
+        self.right_ids.append(right_id)
+        self.statuses.append(status_code)
+        self.met.add(left_id, right_id)
+
+    def add_round(self, round_idx: int, round_file: RoundFile) -> None:
+        """Add meetings of a file parsed by `parse_round_file`, mapping its local ids to the ids of `met`."""
+        user_ids = array.array('I', map(self.met.intern, round_file.users))
+        left_ids = array.array('I', map(user_ids.__getitem__, round_file.left_ids))
+        right_ids = array.array('I', map(user_ids.__getitem__, round_file.right_ids))
+        self.rounds.extend(array.array('H', [round_idx]) * len(left_ids))
+        self.left_ids.extend(left_ids)
+        self.right_ids.extend(right_ids)
+        self.statuses.extend(round_file.statuses)
+        for left_id, right_id in zip(left_ids, right_ids, strict=True):
+            self.met.add(left_id, right_id)
+
+    def iter_meetings(self) -> tp.Iterator[tuple[int, str, str, models.MeetingStatus]]:
+        users = self.met.users
+        for idx in range(len(self)):
+            yield (
+                self.rounds[idx],
+                users[self.left_ids[idx]],
+                users[self.right_ids[idx]],
+                STATUSES[self.statuses[idx]],
+            )
+
+    def nbytes(self) -> int:
+        columns = (self.rounds, self.left_ids, self.right_ids, self.statuses)
+        return sum(column.buffer_info()[1] * column.itemsize for column in columns)
+
+
+def setup(application: te.Application, history: History) -> None:  # type: ignore[type-arg]
+    # not in bot_data: it is deep-copied for persistence and the history is read-only
+    _histories[application] = history
+
+
+def get_history(application: te.Application) -> History | None:  # type: ignore[type-arg]
+    """Return the history of past events loaded by `setup`, if any."""
+    return _histories.get(application)
+
+
+def iter_history_files(history_dir: pathlib.Path) -> list[pathlib.Path]:
+    """History files are named by round index: `0.txt`, `1.txt`, ..., `10.txt`."""
+    return sorted(history_dir.glob('*.txt'), key=lambda path: (len(path.stem), path.stem))
+
+
+def iter_lines(path: pathlib.Path, chunk_size: int = CHUNK_SIZE) -> tp.Iterator[bytes]:
+    """Read the file in chunks of `chunk_size` bytes and yield non-empty lines without line endings."""
+    rest = b''
+    with path.open('rb') as stream:
+        while chunk := stream.read(chunk_size):
+            lines = (rest + chunk).split(b'\n')
+            rest = lines.pop()
+            yield from (line.rstrip(b'\r') for line in lines if line.strip())
+    if rest.strip():
+        yield rest.rstrip(b'\r')
+
+
+def parse_round_file(path: pathlib.Path, chunk_size: int = CHUNK_SIZE) -> RoundFile:
+    """Parse `left,right[,status]` lines of one file, meetings without a status are `done`."""
+    ids: dict[bytes, int] = {}
+    round_file = RoundFile(
+        users=[],
+        left_ids=array.array('I'),
+        right_ids=array.array('I'),
+        statuses=array.array('B'),
+    )
+    default_code = STATUS_CODES[DEFAULT_STATUS.encode()]
+    for line in iter_lines(path, chunk_size):
+        left, right, *status = line.split(b',')
+        left_id = ids.get(left)
+        if left_id is None:
+            left_id = ids[left] = len(round_file.users)
+            round_file.users.append(left.decode())
+        right_id = ids.get(right)
+        if right_id is None:
+            right_id = ids[right] = len(round_file.users)
+            round_file.users.append(right.decode())
+        round_file.left_ids.append(left_id)
+        round_file.right_ids.append(right_id)
+        round_file.statuses.append(STATUS_CODES[status[0].strip()] if status else default_code)
+    return round_file
+
+
+def load_history(
+    paths: tp.Iterable[pathlib.Path],
+    history: History | None = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> History:
+    """Stream the files into `history` one by one, the index of a file is its round."""
+    history = history if history is not None else History()
+    start, size = time.perf_counter(), len(history)
+    for round_idx, path in enumerate(paths):
+        history.add_round(round_idx, parse_round_file(path, chunk_size))
+    elapsed = time.perf_counter() - start
+    logger.info(
+        'Loaded %d meetings of %d users in %.2f seconds',
+        len(history) - size,
+        len(history.met.users),
+        elapsed,
+    )
+    return history
+
+
+def load_history_parallel(
+    paths: tp.Iterable[pathlib.Path],
+    history: History | None = None,
+    workers: int | None = None,
+    chunk_size: int = CHUNK_SIZE,
+) -> History:
+    """
+    Like `load_history`, but parse the files in a process pool and merge them in the order of `paths`.
+
+    At most two files per worker are parsed ahead of the merge, so memory stays bounded.
+    """
+    history = history if history is not None else History()
+    workers = workers or os.cpu_count() or 1
+    start, size = time.perf_counter(), len(history)
+    round_idx = 0
+    with concurrent.futures.ProcessPoolExecutor(max_workers=workers) as executor:
+        pending: collections.deque[concurrent.futures.Future[RoundFile]] = collections.deque()
+        for path in paths:
+            pending.append(executor.submit(parse_round_file, path, chunk_size))
+            if len(pending) == 2 * workers:
+                history.add_round(round_idx, pending.popleft().result())
+                round_idx += 1
+        while pending:
+            history.add_round(round_idx, pending.popleft().result())
+            round_idx += 1
+    elapsed = time.perf_counter() - start
+    logger.info(
+        'Loaded %d meetings of %d users with %d workers in %.2f seconds',
+        len(history) - size,
+        len(history.met.users),
+        workers,
+        elapsed,
+    )
+    return history
+
+
+class BinaryHistory:
+    """
+    Memory-mapped binary history written by `write_binary_history`.
+
+    Rounds are zero-copy slices of the file, nothing is parsed except the usernames.
+    """
+
+    def __init__(self, path: pathlib.Path) -> None:
+        if path.stat().st_size < BINARY_HEADER.size:
+            msg = f'{path} is too short for a binary history'
+            raise exceptions.HistoryFormatError(msg)
+        with path.open('rb') as stream:
+            self._mmap = mmap.mmap(stream.fileno(), 0, access=mmap.ACCESS_READ)
+        try:
+            self.users, pos, rounds_count, meetings_count = self._read_header(path)
+        except exceptions.HistoryFormatError:
+            self._mmap.close()
+            raise
+        self._view = memoryview(self._mmap)
+        self.offsets = self._view[pos : pos + 8 * (rounds_count + 1)].cast('Q')
+        pos += 8 * (rounds_count + 1)
+        self._pairs = self._view[pos : pos + 8 * meetings_count].cast('i')
+        pos += 8 * meetings_count
+        self._statuses = self._view[pos : pos + meetings_count]
+
+    def _read_header(self, path: pathlib.Path) -> tuple[list[str], int, int, int]:
+        """
+        Check the header against the size of the file.
+
+        Return the usernames, the position of the offsets, the number of rounds and of meetings.
+        No views are taken, so the map can still be closed on errors.
+        """
+        magic, version, users_count, rounds_count, users_size = BINARY_HEADER.unpack_from(self._mmap)
+        if magic != BINARY_MAGIC or version != BINARY_VERSION:
+            msg = f'{path} is not a binary history of version {BINARY_VERSION}'
+            raise exceptions.HistoryFormatError(msg)
+        offsets_pos = BINARY_HEADER.size + _padded(users_size)
+        offsets_end = offsets_pos + 8 * (rounds_count + 1)
+        if len(self._mmap) < offsets_end:
+            msg = f'{path} is truncated: {offsets_end} bytes of usernames and rounds, {len(self._mmap)} in the file'
+            raise exceptions.HistoryFormatError(msg)
+        (meetings_count,) = struct.unpack_from('<Q', self._mmap, offsets_end - 8)
+        size = offsets_end + 9 * meetings_count
+        if len(self._mmap) < size:
+            msg = f'{path} is truncated: {size} bytes of {meetings_count} meetings, {len(self._mmap)} in the file'
+            raise exceptions.HistoryFormatError(msg)
+        users_data = self._mmap[BINARY_HEADER.size : BINARY_HEADER.size + users_size]
+        try:
+            users = users_data.decode().split('\n') if users_count else []
+        except UnicodeDecodeError as exc:
+            msg = f'{path} has invalid usernames'
+            raise exceptions.HistoryFormatError(msg) from exc
+        if len(users) != users_count:
+            msg = f'{path} has {len(users)} usernames, {users_count} are declared'
+            raise exceptions.HistoryFormatError(msg)
+        return users, offsets_pos, rounds_count, meetings_count
+
+    def __len__(self) -> int:
+        """Return the number of rounds."""
+        return len(self.offsets) - 1
+
+    def __enter__(self) -> tp.Self:
+        """Return the history, the file is unmapped on exit."""
+        return self
+
+    def __exit__(self, *args: object) -> None:
+        """Unmap the file."""
+        self.close()
+
+    def round(self, round_idx: int) -> memoryview:
+        """Return the meetings of a round as a flat int32 view: left, right, left, right, ..."""
+        return self._pairs[2 * self.offsets[round_idx] : 2 * self.offsets[round_idx + 1]]
+
+    def round_statuses(self, round_idx: int) -> memoryview:
+        return self._statuses[self.offsets[round_idx] : self.offsets[round_idx + 1]]
+
+    def to_history(self, history: History | None = None) -> History:
+        history = history if history is not None else History()
+        for round_idx in range(len(self)):
+            pairs = self.round(round_idx)
+            round_file = RoundFile(
+                users=self.users,
+                left_ids=array.array('I', pairs[::2]),
+                right_ids=array.array('I', pairs[1::2]),
+                statuses=array.array('B', self.round_statuses(round_idx)),
+            )
+            history.add_round(round_idx, round_file)
+        return history
+
+    def close(self) -> None:
+        # views into the map have to be released before it can be closed
+        for view in (self._statuses, self._pairs, self.offsets, self._view):
+            view.release()
+        self._mmap.close()
+
+
+def write_binary_history(path: pathlib.Path, history: History) -> None:
+    """Write `history` in the binary format, its meetings have to be ordered by round."""
+    if sys.byteorder != 'little':
+        msg = 'Binary history is little-endian only'
+        raise exceptions.HistoryFormatError(msg)
+    if any(left > right for left, right in zip(history.rounds, history.rounds[1:], strict=False)):
+        msg = 'Meetings of the history are not ordered by round'
+        raise exceptions.HistoryFormatError(msg)
+    rounds_count = history.rounds[-1] + 1 if history.rounds else 0
+    offsets = array.array('Q', [0] * (rounds_count + 1))
+    for round_idx in history.rounds:
+        offsets[round_idx + 1] += 1
+    for round_idx in range(rounds_count):
+        offsets[round_idx + 1] += offsets[round_idx]
+    pairs = array.array('i', bytes(8 * len(history)))
+    pairs[::2] = array.array('i', history.left_ids)
+    pairs[1::2] = array.array('i', history.right_ids)
+    users = '\n'.join(history.met.users).encode()
+    with path.open('wb') as stream:
+        stream.write(BINARY_HEADER.pack(BINARY_MAGIC, BINARY_VERSION, len(history.met.users), rounds_count, len(users)))
+        stream.write(users.ljust(_padded(len(users)), b'\0'))
+        offsets.tofile(stream)
+        pairs.tofile(stream)
+        history.statuses.tofile(stream)
+
+
+def convert_history(paths: tp.Iterable[pathlib.Path], target: pathlib.Path, workers: int = 1) -> History:
+    """Convert text round files to a binary history file."""
+    history = load_history_parallel(paths, workers=workers) if workers > 1 else load_history(paths)
+    write_binary_history(target, history)
+    return history
+
+
+def _padded(size: int) -> int:
+    return (size + 7) // 8 * 8
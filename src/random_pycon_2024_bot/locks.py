@@ -0,0 +1,45 @@
+import asyncio
+import contextlib
+import typing as tp
+
+
+class KeyedLocks:
+    """
+    FIFO `asyncio.Lock` per key, created on first use.
+
+    A lock is dropped as soon as nobody holds or waits for it, so idle keys take no memory.
+    """
+
+    def __init__(self) -> None:
+        self._locks: dict[str, asyncio.Lock] = {}
+        self._users: dict[str, int] = {}
+
+    def __len__(self) -> int:
+        """Return the number of keys that are held or waited for."""
+        return len(self._locks)
+
+    def locked(self, key: str) -> bool:
+        lock = self._locks.get(key)
+        return lock is not None and lock.locked()
+
+    @contextlib.asynccontextmanager
+    async def hold(self, *keys: str) -> tp.AsyncIterator[None]:
+        """Hold the locks of `keys`, they are taken in sorted order so two holders of a pair can't deadlock."""
+        async with contextlib.AsyncExitStack() as stack:
+            for key in sorted(set(keys)):
+                await stack.enter_async_context(self._hold(key))
+            yield
+
+    @contextlib.asynccontextmanager
+    async def _hold(self, key: str) -> tp.AsyncIterator[None]:
+        lock = self._locks.get(key)
+        if lock is None:
+            lock = self._locks[key] = asyncio.Lock()
+        self._users[key] = self._users.get(key, 0) + 1
+        try:
+            async with lock:
+                yield
+        finally:
+            self._users[key] -= 1
+            if not self._users[key]:
+                del self._users[key], self._locks[key]
@@ -57,6 +57,8 @@ ADMIN_HELP_MESSAGE_RU = ADMIN_HELP_MESSAGE_EN = """
 Администраторы (и ты тоже) могут выполнять следующие команды:
 
 /leaderboard - посмотреть статистику бота по всем пользователям
+/makeround \\[greedy|matching] - назначить встречи нового раунда ВСЕМ пользователям (без уведомлений)
+/recount - пересчитать счётчики встреч для /stats и /leaderboard
 /newround - сообщить ВСЕМ пользователям, что у них есть новые встречи (начало нового рауда)
 /notifyall - напомнить ВСЕМ пользователям, что им нужно отметить встречи (по пятницам вызывать лучше всего)
 
@@ -227,10 +229,45 @@ LEADER_BOARD_MESSAGE_RU = LEADER_BOARD_MESSAGE_EN = """
 Всего раундов: {all_rounds}
 Всего авторизовались у бота: {all_auth}
 Всего людей, участвовавших во встречах: {all_members}
+Заблокировали бота: {all_blocked}
 Всего назначенных встреч: {all_meetings}
 Всего подтвержденных встреч: {all_passed}
 Всего отклоненных встреч: {all_denied}
 Всего неотмеченных встреч (среди авторизовавшихся): {all_notyet}
+
+Последние раунды:
+{rounds}
+"""
+
+LEADER_BOARD_ROUND = 'LEADER_BOARD_ROUND'
+LEADER_BOARD_ROUND_RU = LEADER_BOARD_ROUND_EN = (
+    'Раунд {round_id}: встреч {meetings}, подтверждено {done}, отклонено {nope}, '
+    'не отмечено {pending}, участников {participants}'
+)
+
+COUNTERS_REBUILT_MESSAGE = 'COUNTERS_REBUILT_MESSAGE'
+COUNTERS_REBUILT_MESSAGE_RU = COUNTERS_REBUILT_MESSAGE_EN = """
+Счётчики встреч пересчитаны, расходились у пользователей: {mismatches}
+"""
+
+ROUND_CREATED_MESSAGE = 'ROUND_CREATED_MESSAGE'
+ROUND_CREATED_MESSAGE_RU = ROUND_CREATED_MESSAGE_EN = """
+Раунд {round_id} создан:
+Назначено встреч: {pairs}
+Повторных встреч: {repeats}
+Остались без пары: {unmatched}
+
+Чтобы разослать уведомления, набери /newround
+"""
+
+UNKNOWN_ALGORITHM_MESSAGE = 'UNKNOWN_ALGORITHM_MESSAGE'
+UNKNOWN_ALGORITHM_MESSAGE_RU = UNKNOWN_ALGORITHM_MESSAGE_EN = """
+Неизвестный алгоритм. Доступные алгоритмы: {algorithms}
+"""
+
+BROADCAST_STARTED_MESSAGE = 'BROADCAST_STARTED_MESSAGE'
+BROADCAST_STARTED_MESSAGE_RU = BROADCAST_STARTED_MESSAGE_EN = """
+Рассылка {job_id} запущена, получателей: {total}
 """
 
 REMIND_PEOPLE_TO_MARK_MEETINGS = 'REMIND_PEOPLE_TO_MARK_MEETINGS'
@@ -309,6 +346,14 @@ MEETING_IS_DECLINED_LABEL = 'MEETING_IS_DECLINED_LABEL'
 MEETING_IS_DECLINED_LABEL_RU = 'встреча не состоится'
 MEETING_IS_DECLINED_LABEL_EN = 'meeting is declined'
 
+WHO_PREV_PAGE_LABEL = 'WHO_PREV_PAGE_LABEL'
+WHO_PREV_PAGE_LABEL_RU = '‹ назад'
+WHO_PREV_PAGE_LABEL_EN = '‹ back'
+
+WHO_NEXT_PAGE_LABEL = 'WHO_NEXT_PAGE_LABEL'
+WHO_NEXT_PAGE_LABEL_RU = 'дальше ›'
+WHO_NEXT_PAGE_LABEL_EN = 'next ›'
+
 TELEGRAM_MENTION = 'TELEGRAM_MENTION'
 TELEGRAM_MENTION_RU = 'телеграм: [@{tg_login}](mention:{tg_login})'
 TELEGRAM_MENTION_EN = 'telegram: [@{tg_login}](mention:{tg_login})'
@@ -414,6 +459,26 @@ MESSAGES: tp.Mapping[str, tp.Mapping[str, str]] = {
         'en': LEADER_BOARD_MESSAGE_EN,
         'ru': LEADER_BOARD_MESSAGE_RU,
     },
+    COUNTERS_REBUILT_MESSAGE: {
+        'en': COUNTERS_REBUILT_MESSAGE_EN,
+        'ru': COUNTERS_REBUILT_MESSAGE_RU,
+    },
+    LEADER_BOARD_ROUND: {
+        'en': LEADER_BOARD_ROUND_EN,
+        'ru': LEADER_BOARD_ROUND_RU,
+    },
+    ROUND_CREATED_MESSAGE: {
+        'en': ROUND_CREATED_MESSAGE_EN,
+        'ru': ROUND_CREATED_MESSAGE_RU,
+    },
+    UNKNOWN_ALGORITHM_MESSAGE: {
+        'en': UNKNOWN_ALGORITHM_MESSAGE_EN,
+        'ru': UNKNOWN_ALGORITHM_MESSAGE_RU,
+    },
+    BROADCAST_STARTED_MESSAGE: {
+        'en': BROADCAST_STARTED_MESSAGE_EN,
+        'ru': BROADCAST_STARTED_MESSAGE_RU,
+    },
     ERROR_MESSAGE: {
         'en': ERROR_MESSAGE_EN,
         'ru': ERROR_MESSAGE_RU,
@@ -442,6 +507,14 @@ MESSAGES: tp.Mapping[str, tp.Mapping[str, str]] = {
         'en': MEETING_IS_DECLINED_LABEL_EN,
         'ru': MEETING_IS_DECLINED_LABEL_RU,
     },
+    WHO_PREV_PAGE_LABEL: {
+        'en': WHO_PREV_PAGE_LABEL_EN,
+        'ru': WHO_PREV_PAGE_LABEL_RU,
+    },
+    WHO_NEXT_PAGE_LABEL: {
+        'en': WHO_NEXT_PAGE_LABEL_EN,
+        'ru': WHO_NEXT_PAGE_LABEL_RU,
+    },
     INTEREST_ADDED: {
         'en': INTEREST_ADDED_EN,
         'ru': INTEREST_ADDED_RU,
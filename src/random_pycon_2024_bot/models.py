@@ -1,4 +1,6 @@
+import collections
 import dataclasses
+import datetime
 import enum
 import typing as tp
 
@@ -20,8 +22,17 @@ class MeetingStatus(enum.StrEnum):
     more = enum.auto()
 
 
+@enum.unique
+class OutboxStatus(enum.StrEnum):
+    pending = enum.auto()
+    sent = enum.auto()
+    failed = enum.auto()
+    forbidden = enum.auto()
+
+
 PENDING_MEETINGS = {MeetingStatus.showed, MeetingStatus.asked, MeetingStatus.yet}
 ALL_MEETINGS = {*PENDING_MEETINGS, MeetingStatus.done, MeetingStatus.nope}
+MATCHED_MEETINGS = {*ALL_MEETINGS, MeetingStatus.created}
 
 
 @dataclasses.dataclass
@@ -32,6 +43,40 @@ class WebhookUpdate:
     payload: str
 
 
+@dataclasses.dataclass
+class MeetingsPage:
+    """A page of a user's meetings, cursors are positions in the list of the user's meetings."""
+
+    meetings: list['CacheMeeting']
+    prev_cursor: int | None
+    next_cursor: int | None
+
+
+@dataclasses.dataclass
+class MeetingCounters:
+    """Meetings by status of every owner, and totals over the owners who are enabled."""
+
+    users: dict[str, collections.Counter[MeetingStatus]] = dataclasses.field(default_factory=dict)
+    total: collections.Counter[MeetingStatus] = dataclasses.field(default_factory=collections.Counter)
+    # enabled owners with at least one meeting of `ALL_MEETINGS`
+    users_with_meetings: int = 0
+    # both sides of the meetings of every round by status, disabled owners included
+    rounds: dict[int, collections.Counter[MeetingStatus]] = dataclasses.field(default_factory=dict)
+
+
+@dataclasses.dataclass
+class RoundStats:
+    """Meetings of a round, a user has at most one meeting per round, so participants are the sides."""
+
+    round_id: int
+    created_at: str
+    meetings: int
+    done: int
+    nope: int
+    pending: int
+    participants: int
+
+
 class Base(orm.DeclarativeBase): ...
 
 
@@ -66,14 +111,110 @@ class Persistence(Base):
     data: Data = sa.Column(PydanticType(Data), server_default='{}')  # type: ignore[assignment]
 
 
+class PersistenceEntry(Base):
+    """One JSON-encoded value of the persisted state, e.g. a single user's `user_data`."""
+
+    __tablename__ = 'persistence_entry'
+    namespace: str = sa.Column(sa.String, primary_key=True)  # type: ignore[assignment]
+    key: str = sa.Column(sa.String, primary_key=True)  # type: ignore[assignment]
+    value: str = sa.Column(sa.String, nullable=False)  # type: ignore[assignment]
+
+
+class User(Base):
+    __tablename__ = 'telegram_user'
+    user_id: str = sa.Column(sa.String, primary_key=True)  # type: ignore[assignment]
+    username: str | None = sa.Column(sa.String, index=True)  # type: ignore[assignment]
+    chat_id: str | None = sa.Column(sa.String)  # type: ignore[assignment]
+    enabled: bool | None = sa.Column(sa.Boolean)  # type: ignore[assignment]
+    lang_code: str | None = sa.Column(sa.String)  # type: ignore[assignment]
+    blocked_at: str | None = sa.Column(sa.String)  # type: ignore[assignment]
+
+
+class Meeting(Base):
+    """One side of a meeting: `right_id` is the partner of `left_id`, `position` keeps the order of creation."""
+
+    __tablename__ = 'meeting'
+    left_id: str = sa.Column(sa.String, primary_key=True)  # type: ignore[assignment]
+    position: int = sa.Column(sa.Integer, primary_key=True)  # type: ignore[assignment]
+    right_id: str = sa.Column(sa.String, nullable=False)  # type: ignore[assignment]
+    status: MeetingStatus = sa.Column(sa.String, nullable=False)  # type: ignore[assignment]
+    # meetings of /more are not a part of any round
+    round_id: int | None = sa.Column(sa.Integer)  # type: ignore[assignment]
+    waiting_since: str | None = sa.Column(sa.String)  # type: ignore[assignment]
+
+
+class Round(Base):
+    __tablename__ = 'round'
+    round_id: int = sa.Column(sa.Integer, primary_key=True)  # type: ignore[assignment]
+    created_at: str = sa.Column(sa.String, nullable=False)  # type: ignore[assignment]
+    algorithm: str = sa.Column(sa.String, nullable=False)  # type: ignore[assignment]
+    pairs: int = sa.Column(sa.Integer, nullable=False)  # type: ignore[assignment]
+    repeats: int = sa.Column(sa.Integer, nullable=False)  # type: ignore[assignment]
+    unmatched: int = sa.Column(sa.Integer, nullable=False)  # type: ignore[assignment]
+
+
+class OutboxMessage(Base):
+    """
+    An outbound Telegram message waiting to be sent or already sent.
+
+    `key` makes enqueueing idempotent, messages of a chat are sent in the order of `id`.
+    """
+
+    __tablename__ = 'outbox_message'
+    __table_args__ = (sa.Index('ix_outbox_message_status_chat_id', 'status', 'chat_id'),)
+    id: int = sa.Column(sa.Integer, primary_key=True, autoincrement=True)  # type: ignore[assignment]
+    key: str = sa.Column(sa.String, nullable=False, unique=True)  # type: ignore[assignment]
+    chat_id: str = sa.Column(sa.String, nullable=False)  # type: ignore[assignment]
+    text: str = sa.Column(sa.String, nullable=False)  # type: ignore[assignment]
+    parse_mode: str | None = sa.Column(sa.String)  # type: ignore[assignment]
+    job_id: str | None = sa.Column(sa.String, index=True)  # type: ignore[assignment]
+    status: OutboxStatus = sa.Column(sa.String, nullable=False, default=OutboxStatus.pending)  # type: ignore[assignment]
+    created_at: datetime.datetime = sa.Column(sa.DateTime, nullable=False, default=sa.func.now())  # type: ignore[assignment]
+
+
+@dataclasses.dataclass
+class StoredState:
+    """Rows loaded from the database on startup."""
+
+    data: Data
+    entries: list[PersistenceEntry]
+    users: list[User]
+    meetings: list[Meeting]
+    rounds: list[Round]
+
+
 class TelegramUser(tp.TypedDict):
     user_id: str
     username: str
     chat_id: str
     enabled: bool
     lang_code: str
+    # ISO time when sending to the user failed with Forbidden, cleared by /start
+    blocked_at: tp.NotRequired[str]
+
+
+@dataclasses.dataclass(slots=True)
+class CacheMeeting:
+    """
+    One side of a meeting in memory, `user_id` is the partner.
 
+    There is one per side of every meeting, so it is slotted: 64 bytes instead of 184 of a dict,
+    and the ids are interned strings shared with the rest of `bot_data`.
+    """
 
-class CacheMeeting(tp.TypedDict):
     user_id: str
     status: MeetingStatus
+    # meetings of /more are not a part of any round
+    round_id: int | None = None
+    # ISO time of /more while the meeting waits for a partner, it keeps the waiting pool in order across restarts
+    waiting_since: str | None = None
+
+
+class RoundInfo(tp.TypedDict):
+    round_id: int
+    # ISO time of /makeround
+    created_at: str
+    algorithm: str
+    pairs: int
+    repeats: int
+    unmatched: int
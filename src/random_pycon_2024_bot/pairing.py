@@ -0,0 +1,181 @@
+import array
+import bisect
+import dataclasses
+import random
+import typing as tp
+
+TPair = tuple[str, str]
+TIdPair = tuple[int, int]
+
+DEFAULT_ALGORITHM = 'greedy'
+
+
+class MetMatrix:
+    """
+    Who has met whom, with users interned to dense integer ids.
+
+    Partners of a user are kept as a sorted array of ids, a sparse bitset of 4 bytes per meeting.
+    """
+
+    def __init__(self) -> None:
+        self.ids: dict[str, int] = {}
+        self.users: list[str] = []
+        self._partners: list[array.array[int]] = []
+
+    @classmethod
+    def from_pairs(cls, pairs: tp.Iterable[TPair]) -> tp.Self:
+        met = cls()
+        for left, right in pairs:
+            met.add(met.intern(left), met.intern(right))
+        return met
+
+    def intern(self, user: str) -> int:
+        user_id = self.ids.get(user)
+        if user_id is None:
+            user_id = self.ids[user] = len(self.users)
+            self.users.append(user)
+            self._partners.append(array.array('I'))
+        return user_id
+
+    def add(self, left_id: int, right_id: int) -> None:
+        if left_id == right_id or self.met(left_id, right_id):
+            return
+        bisect.insort(self._partners[left_id], right_id)
+        bisect.insort(self._partners[right_id], left_id)
+
+    def met(self, left_id: int, right_id: int) -> bool:
+        partners = self._partners[left_id]
+        idx = bisect.bisect_left(partners, right_id)
+        return idx < len(partners) and partners[idx] == right_id
+
+    def partners(self, user: str) -> list[str]:
+        user_id = self.ids.get(user)
+        return [] if user_id is None else [self.users[partner_id] for partner_id in self._partners[user_id]]
+
+    def nbytes(self) -> int:
+        """Size of the partner arrays, without the interned names."""
+        return sum(partners.buffer_info()[1] * partners.itemsize for partners in self._partners)
+
+
+@dataclasses.dataclass
+class Round:
+    pairs: list[TPair]
+    unmatched: list[str]
+    repeats: int
+
+
+class PairingAlgorithm(tp.Protocol):
+    def __call__(self, users: list[int], met: MetMatrix, rng: random.Random) -> list[TIdPair]: ...
+
+
+def make_round(
+    users: tp.Iterable[str],
+    met: MetMatrix,
+    algorithm: str = DEFAULT_ALGORITHM,
+    seed: int | None = None,
+) -> Round:
+    """Pair users for a new round avoiding the meetings in `met`."""
+    user_ids = [met.intern(user) for user in users]
+    pairs = ALGORITHMS[algorithm](user_ids, met, random.Random(seed))  # noqa: S311
+    paired = {user_id for pair in pairs for user_id in pair}
+    return Round(
+        pairs=[(met.users[left_id], met.users[right_id]) for left_id, right_id in pairs],
+        unmatched=[met.users[user_id] for user_id in user_ids if user_id not in paired],
+        repeats=sum(1 for left_id, right_id in pairs if met.met(left_id, right_id)),
+    )
+
+
+def pair_greedy(users: list[int], met: MetMatrix, rng: random.Random) -> list[TIdPair]:
+    """Pair neighbours in a shuffled order, users who are left over meet again with someone."""
+    pairs, leftovers = _greedy(users, met, rng)
+    return pairs + _pair_repeats(leftovers, rng)
+
+
+def pair_matching(users: list[int], met: MetMatrix, rng: random.Random) -> list[TIdPair]:
+    """Like `pair_greedy`, but rewire existing pairs to find new partners for users who are left over."""
+    pairs, leftovers = _greedy(users, met, rng)
+    leftovers = _augment(pairs, leftovers, met)
+    return pairs + _pair_repeats(leftovers, rng)
+
+
+ALGORITHMS: dict[str, PairingAlgorithm] = {
+    'greedy': pair_greedy,
+    'matching': pair_matching,
+}
+
+
+def _greedy(users: list[int], met: MetMatrix, rng: random.Random) -> tuple[list[TIdPair], list[int]]:
+    order = list(users)
+    rng.shuffle(order)
+    size = len(order)
+    # next_free[pos] leads to the first position >= pos which is not taken yet, `size` is the sentinel
+    next_free = list(range(size + 1))
+
+    def find_free(pos: int) -> int:
+        root = pos
+        while next_free[root] != root:
+            root = next_free[root]
+        while next_free[pos] != root:
+            next_free[pos], pos = root, next_free[pos]
+        return root
+
+    pairs: list[TIdPair] = []
+    leftovers: list[int] = []
+    for pos, left in enumerate(order):
+        if next_free[pos] != pos:
+            continue
+        next_free[pos] = pos + 1
+        right_pos = find_free(pos + 1)
+        while right_pos < size and met.met(left, order[right_pos]):
+            right_pos = find_free(right_pos + 1)
+        if right_pos == size:
+            leftovers.append(left)
+            continue
+        next_free[right_pos] = right_pos + 1
+        pairs.append((left, order[right_pos]))
+    return pairs, leftovers
+
+
+def _augment(pairs: list[TIdPair], unmatched: list[int], met: MetMatrix) -> list[int]:
+    """
+    Pair unmatched users without repeats, rewiring one existing pair if needed: u, (v, w), x -> (u, v), (w, x).
+
+    Return users who are still unmatched. `pairs` is updated in place.
+    """
+    remaining: list[int] = []
+    unmatched = list(unmatched)
+    while unmatched:
+        user = unmatched.pop()
+        other = next((other for other in unmatched if not met.met(user, other)), None)
+        if other is not None:
+            unmatched.remove(other)
+            pairs.append((user, other))
+            continue
+        swap = _find_swap(user, pairs, unmatched, met)
+        if swap is None:
+            remaining.append(user)
+            continue
+        idx, left, right, other = swap
+        unmatched.remove(other)
+        pairs[idx] = (user, left)
+        pairs.append((right, other))
+    return remaining
+
+
+def _find_swap(
+    user: int, pairs: list[TIdPair], unmatched: list[int], met: MetMatrix
+) -> tuple[int, int, int, int] | None:
+    for idx, (first, second) in enumerate(pairs):
+        for left, right in ((first, second), (second, first)):
+            if met.met(user, left):
+                continue
+            other = next((other for other in unmatched if not met.met(right, other)), None)
+            if other is not None:
+                return idx, left, right, other
+    return None
+
+
+def _pair_repeats(users: list[int], rng: random.Random) -> list[TIdPair]:
+    users = list(users)
+    rng.shuffle(users)
+    return list(zip(users[::2], users[1::2], strict=False))
@@ -7,19 +7,53 @@ from sqlalchemy.ext.asyncio import async_scoped_session
 from sqlalchemy.ext.asyncio import async_sessionmaker
 import telegram.ext as te
 
+from random_pycon_2024_bot import codec
 from random_pycon_2024_bot import db
 from random_pycon_2024_bot import models
 
 logger = logging.getLogger(__name__)
 
+TEntryKey = tuple[str, str]
+_T = tp.TypeVar('_T')
+
+USER_DATA = 'user_data'
+CHAT_DATA = 'chat_data'
+BOT_DATA = 'bot_data'
+CONVERSATIONS = 'conversations'
+CALLBACK_DATA = 'callback_data'
+# users, meetings and rounds have their own tables, logins are rebuilt from users on load
+USERS = f'{BOT_DATA}.users'
+MEETINGS = f'{BOT_DATA}.meetings'
+ROUNDS = f'{BOT_DATA}.rounds'
+LOGINS = f'{BOT_DATA}.logins'
+
+_MISSING = object()
+
 
 class SqlitePersistence(te.DictPersistence):
-    def __init__(self, db_engine: sa.Engine, data: models.Data, **kwargs: tp.Any) -> None:  # noqa: ANN401
+    """
+    Keeps the state in memory and writes it to SQLite after updates.
+
+    With a positive `flush_interval` updates only mark the state as changed and a background task
+    writes it at most once per interval, so the state on disk is never older than `flush_interval`
+    seconds. Use `flush` to write the pending changes right away.
+    """
+
+    def __init__(
+        self,
+        db_engine: sa.Engine,
+        data: models.Data,
+        flush_interval: float = 0,
+        **kwargs: tp.Any,  # noqa: ANN401
+    ) -> None:
         self._engine = db_engine
         self._session = async_scoped_session(
             async_sessionmaker(bind=self._engine),  # type: ignore[call-overload]
             asyncio.current_task,
         )
+        self._flush_interval = flush_interval
+        self._flush_lock = asyncio.Lock()
+        self._flush_task: asyncio.Task[None] | None = None
         super().__init__(
             **kwargs,
             chat_data_json=data.chat_data_json,
@@ -28,26 +62,65 @@ class SqlitePersistence(te.DictPersistence):
             callback_data_json=data.callback_data_json,
             conversations_json=data.conversations_json,
         )
+        if self._bot_data is not None and 'meetings' in self._bot_data:
+            self._bot_data['meetings'] = db.meetings_from_json(self._bot_data['meetings'])
+
+    @property
+    def bot_data_json(self) -> str:
+        """Return `bot_data` serialized as JSON, meetings are saved as dicts."""
+        if self._bot_data_json:
+            return self._bot_data_json
+        return codec.dumps(self.bot_data, default=_encode_record)
 
     async def update_conversation(self, name: str, key: tuple[int | str, ...], new_state: object | None) -> None:
         await super().update_conversation(name, key, new_state)
-        await self._flush()
+        await self._schedule_flush()
 
     async def update_user_data(self, user_id: int, data: dict[str, tp.Any]) -> None:
         await super().update_user_data(user_id, data)
-        await self._flush()
+        await self._schedule_flush()
 
     async def update_chat_data(self, chat_id: int, data: dict[str, tp.Any]) -> None:
         await super().update_chat_data(chat_id, data)
-        await self._flush()
+        await self._schedule_flush()
 
     async def update_bot_data(self, data: dict[str, tp.Any]) -> None:
         await super().update_bot_data(data)
-        await self._flush()
+        await self._schedule_flush()
 
     async def update_callback_data(self, data: tp.Any) -> None:  # noqa: ANN401
         await super().update_callback_data(data)
-        await self._flush()
+        await self._schedule_flush()
+
+    async def flush(self) -> None:
+        if self._flush_task is not None:
+            self._flush_task.cancel()
+            self._flush_task = None
+        await self._write()
+
+    async def _schedule_flush(self) -> None:
+        if self._flush_interval <= 0:
+            await self.flush()
+        elif self._flush_task is None:
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self) -> None:
+        await asyncio.sleep(self._flush_interval)
+        # detach before writing, so a concurrent `flush` waits for the lock instead of cancelling the write
+        self._flush_task = None
+        try:
+            await self._write()
+        except Exception:
+            logger.exception('Failed to flush persistence, retrying in %s seconds', self._flush_interval)
+            await self._schedule_flush()
+
+    async def _write(self) -> None:
+        async with self._flush_lock:
+            try:
+                await self._flush()
+            finally:
+                # sessions are scoped by task, drop this one so they don't pile up
+                await self._session.remove()
 
     async def _flush(self) -> None:
         data = models.Data(
@@ -58,3 +131,193 @@ class SqlitePersistence(te.DictPersistence):
             conversations_json=self.conversations_json,
         )
         await db.flush_persistence(self._session, data)
+
+
+class IncrementalSqlitePersistence(SqlitePersistence):
+    """
+    Stores every user, chat and `bot_data` entry in its own row and writes only the changed ones.
+
+    Dict values of `bot_data` are split one level deeper, users, meetings and rounds go to their own tables,
+    so a status update of a single meeting rewrites only the meetings of one user.
+    """
+
+    def __init__(
+        self,
+        db_engine: sa.Engine,
+        state: models.StoredState,
+        **kwargs: tp.Any,  # noqa: ANN401
+    ) -> None:
+        self._dirty: set[TEntryKey] = set()
+        if not (state.entries or state.users or state.meetings or state.rounds):
+            # first start after the single-row persistence: migrate everything on the first flush
+            super().__init__(db_engine, data=state.data, **kwargs)
+            self._dirty = set(self._iter_keys())
+            return
+        super().__init__(db_engine, data=models.Data(), **kwargs)
+        self._load_state(state)
+
+    async def update_conversation(self, name: str, key: tuple[int | str, ...], new_state: object | None) -> None:
+        if (self.conversations or {}).get(name, {}).get(key, _MISSING) != new_state:
+            self._dirty.add((CONVERSATIONS, name))
+        await super().update_conversation(name, key, new_state)
+
+    async def update_user_data(self, user_id: int, data: dict[str, tp.Any]) -> None:
+        if (self.user_data or {}).get(user_id) != data:
+            self._dirty.add((USER_DATA, str(user_id)))
+        await super().update_user_data(user_id, data)
+
+    async def update_chat_data(self, chat_id: int, data: dict[str, tp.Any]) -> None:
+        if (self.chat_data or {}).get(chat_id) != data:
+            self._dirty.add((CHAT_DATA, str(chat_id)))
+        await super().update_chat_data(chat_id, data)
+
+    async def update_bot_data(self, data: dict[str, tp.Any]) -> None:
+        self._dirty.update(_diff_bot_data(self.bot_data or {}, data))
+        await super().update_bot_data(data)
+
+    async def update_callback_data(self, data: tp.Any) -> None:  # noqa: ANN401
+        if self.callback_data != data:
+            self._dirty.add((CALLBACK_DATA, ''))
+        await super().update_callback_data(data)
+
+    async def drop_user_data(self, user_id: int) -> None:
+        await super().drop_user_data(user_id)
+        self._dirty.add((USER_DATA, str(user_id)))
+        await self._schedule_flush()
+
+    async def drop_chat_data(self, chat_id: int) -> None:
+        await super().drop_chat_data(chat_id)
+        self._dirty.add((CHAT_DATA, str(chat_id)))
+        await self._schedule_flush()
+
+    async def _flush(self) -> None:
+        if not self._dirty:
+            return
+        dirty, self._dirty = self._dirty, set()
+        bot_data = self.bot_data or {}
+        upserts: dict[TEntryKey, str] = {}
+        deletes: set[TEntryKey] = set()
+        # keys of the sections of `bot_data` with their own tables
+        table_keys: dict[str, set[str]] = {USERS: set(), MEETINGS: set(), ROUNDS: set()}
+        for entry_key in dirty:
+            namespace, key = entry_key
+            if namespace == LOGINS:
+                continue
+            if namespace in table_keys:
+                table_keys[namespace].add(key)
+                continue
+            value = self._encode_entry(entry_key)
+            if value is None:
+                deletes.add(entry_key)
+            else:
+                upserts[entry_key] = value
+        changed_users, deleted_users = _split_section(table_keys[USERS], bot_data.get('users', {}))
+        changed_rounds, deleted_rounds = _split_section(table_keys[ROUNDS], bot_data.get('rounds', {}))
+        meetings = bot_data.get('meetings', {})
+        changed_meetings = {key: meetings.get(key, []) for key in table_keys[MEETINGS]}
+        logger.debug(
+            'Flushing %d changed and %d deleted entries, %d users, meetings of %d users, %d rounds',
+            len(upserts),
+            len(deletes),
+            len(changed_users) + len(deleted_users),
+            len(changed_meetings),
+            len(changed_rounds) + len(deleted_rounds),
+        )
+        try:
+            async with self._session.begin():
+                await db.flush_persistence_entries(self._session, upserts, deletes)
+                await db.flush_users(self._session, changed_users, deleted_users)
+                await db.flush_meetings(self._session, changed_meetings)
+                await db.flush_rounds(self._session, changed_rounds, deleted_rounds)
+        except Exception:
+            # keep the entries dirty so that the next flush retries them
+            self._dirty |= dirty
+            raise
+
+    def _iter_keys(self) -> tp.Iterator[TEntryKey]:
+        yield from ((USER_DATA, str(user_id)) for user_id in self.user_data or {})
+        yield from ((CHAT_DATA, str(chat_id)) for chat_id in self.chat_data or {})
+        yield from ((CONVERSATIONS, name) for name in self.conversations or {})
+        yield from _diff_bot_data({}, self.bot_data or {})
+        if self.callback_data is not None:
+            yield (CALLBACK_DATA, '')
+
+    def _encode_entry(self, entry_key: TEntryKey) -> str | None:
+        namespace, key = entry_key
+        value: tp.Any = _MISSING
+        if namespace == USER_DATA:
+            value = (self.user_data or {}).get(int(key), _MISSING)
+        elif namespace == CHAT_DATA:
+            value = (self.chat_data or {}).get(int(key), _MISSING)
+        elif namespace == CONVERSATIONS:
+            conversation = (self.conversations or {}).get(key)
+            return self._encode_conversations_to_json({key: conversation}) if conversation is not None else None
+        elif namespace == CALLBACK_DATA:
+            value = self.callback_data if self.callback_data is not None else _MISSING
+        elif namespace == BOT_DATA:
+            value = (self.bot_data or {}).get(key, _MISSING)
+            if isinstance(value, dict):
+                # dict values are stored entry by entry in their own namespace
+                return None
+        else:
+            section = (self.bot_data or {}).get(namespace.removeprefix(f'{BOT_DATA}.'))
+            value = section.get(key, _MISSING) if isinstance(section, dict) else _MISSING
+        return codec.dumps(value) if value is not _MISSING else None
+
+    def _load_state(self, state: models.StoredState) -> None:
+        user_data: dict[int, tp.Any] = {}
+        chat_data: dict[int, tp.Any] = {}
+        bot_data: dict[str, tp.Any] = {}
+        conversations: dict[str, tp.Any] = {}
+        for entry in state.entries:
+            if entry.namespace == CONVERSATIONS:
+                conversations.update(self._decode_conversations_from_json(entry.value))
+                continue
+            value = codec.loads(entry.value)
+            if entry.namespace == USER_DATA:
+                user_data[int(entry.key)] = value
+            elif entry.namespace == CHAT_DATA:
+                chat_data[int(entry.key)] = value
+            elif entry.namespace == CALLBACK_DATA:
+                self._callback_data = ([(one, float(two), three) for one, two, three in value[0]], value[1])
+            elif entry.namespace == BOT_DATA:
+                bot_data[entry.key] = value
+            else:
+                bot_data.setdefault(entry.namespace.removeprefix(f'{BOT_DATA}.'), {})[entry.key] = value
+        users = db.users_from_rows(state.users)
+        bot_data['users'] = users
+        bot_data['logins'] = {user['username']: user for user in users.values() if 'username' in user}
+        bot_data['meetings'] = db.meetings_from_rows(state.meetings)
+        bot_data['rounds'] = db.rounds_from_rows(state.rounds)
+        self._user_data = user_data
+        self._chat_data = chat_data
+        self._bot_data = bot_data
+        self._conversations = conversations
+
+
+def _split_section(keys: set[str], section: dict[str, _T]) -> tuple[dict[str, _T], set[str]]:
+    """Split changed keys of a section of `bot_data` into the current values and the deleted keys."""
+    return {key: section[key] for key in keys if key in section}, {key for key in keys if key not in section}
+
+
+def _encode_record(value: object) -> tp.Any:  # noqa: ANN401
+    if isinstance(value, models.CacheMeeting):
+        return db.meeting_to_json(value)
+    msg = f'Object of type {type(value).__name__} is not JSON serializable'
+    raise TypeError(msg)
+
+
+def _diff_bot_data(previous: dict[str, tp.Any], current: dict[str, tp.Any]) -> tp.Iterator[TEntryKey]:
+    """Yield keys of the entries that differ, comparing dict values of `bot_data` key by key."""
+    for top_key in previous.keys() | current.keys():
+        old, new = previous.get(top_key, _MISSING), current.get(top_key, _MISSING)
+        if old == new:
+            continue
+        if not isinstance(old, dict) or not isinstance(new, dict):
+            yield (BOT_DATA, top_key)
+        old_section = old if isinstance(old, dict) else {}
+        new_section = new if isinstance(new, dict) else {}
+        namespace = f'{BOT_DATA}.{top_key}'
+        for key in old_section.keys() | new_section.keys():
+            if old_section.get(key, _MISSING) != new_section.get(key, _MISSING):
+                yield (namespace, str(key))
@@ -1,3 +1,6 @@
+import pathlib
+import typing as tp
+
 import pydantic
 import pydantic_settings as ps
 
@@ -9,6 +12,35 @@ class Settings(ps.BaseSettings):
     url: str = pydantic.Field(default='https://domain.tld')
     admin_chat_id: int = pydantic.Field()
     port: int = pydantic.Field(default=8000)
+    incremental_persistence: bool = pydantic.Field(default=True)
+    # meetings per page of /who and /all
+    who_page_size: int = pydantic.Field(default=10, ge=1)
+    # rounds shown by /leaderboard
+    leaderboard_rounds: int = pydantic.Field(default=5, ge=1)
+    # handlers running at once and updates taken from the queue, updates of one user are handled in order
+    update_concurrency: int = pydantic.Field(default=32, ge=1)
+    max_pending_updates: int = pydantic.Field(default=1024, ge=1)
+    # updates waiting to be handled, a full queue drops inline queries and plain texts first or rejects with 429
+    update_queue_size: int = pydantic.Field(default=20_000, ge=1)
+    update_queue_policy: tp.Literal['shed', 'reject'] = pydantic.Field(default='shed')
+    # queued updates above which batches of updates are rejected with 429, leaves room for live updates
+    update_queue_high_water: int = pydantic.Field(default=10_000, ge=1)
+    # POST /telegram/batch is disabled unless set, its requests have to send it in the X-Batch-Secret header
+    batch_secret: str | None = pydantic.Field(default=None)
+    # JSON of webhook batches, persistence and the database, `auto` takes orjson or msgspec if installed
+    json_codec: tp.Literal['auto', 'orjson', 'msgspec', 'json'] = pydantic.Field(default='auto')
+    # round files of past events, `/makeround` doesn't pair their users again
+    history_dir: pathlib.Path | None = pydantic.Field(default=None)
+    # seconds between coalesced persistence writes, 0 writes after every update
+    persistence_flush_interval: float = pydantic.Field(default=1.0, ge=0)
+    # Telegram allows about 30 messages per second overall and 1 per second to a chat
+    broadcast_concurrency: int = pydantic.Field(default=16, ge=1)
+    broadcast_rate: float = pydantic.Field(default=25.0, gt=0)
+    broadcast_chat_rate: float = pydantic.Field(default=1.0, gt=0)
+    broadcast_max_retries: int = pydantic.Field(default=3, ge=0)
+    outbox_batch_size: int = pydantic.Field(default=100, ge=1)
+    outbox_poll_interval: float = pydantic.Field(default=1.0, gt=0)
+    outbox_retention_days: float = pydantic.Field(default=7.0, ge=0)
 
 
 settings = Settings()
@@ -0,0 +1,121 @@
+import logging
+import string
+import typing as tp
+
+from telegram.helpers import escape_markdown
+
+from random_pycon_2024_bot import exceptions
+from random_pycon_2024_bot import messages
+from random_pycon_2024_bot import models
+
+logger = logging.getLogger(__name__)
+
+FALLBACK_LANG_CODE = 'ru'
+CLOSED_STATUSES = frozenset({models.MeetingStatus.done, models.MeetingStatus.nope})
+
+_formatter = string.Formatter()
+
+
+class Template:
+    """
+    A message of one language, parsed once.
+
+    Placeholders have to be plain names, `render` formats with the bound `str.format` of the text,
+    and a template without placeholders renders to the same string object every time.
+    """
+
+    __slots__ = ('_format', 'code', 'fields', 'lang_code', 'text')
+
+    def __init__(self, code: str, lang_code: str, text: str) -> None:
+        self.code = code
+        self.lang_code = lang_code
+        self.fields = _parse_fields(code, lang_code, text)
+        # without placeholders the text is rendered right away, so escaped braces are unescaped once
+        self.text = text.format() if not self.fields else text
+        self._format = self.text.format
+
+    def __repr__(self) -> str:
+        """Return the message code, the language and the placeholders."""
+        return f'Template({self.code!r}, {self.lang_code!r}, fields={sorted(self.fields)})'
+
+    def render(self, **kwargs: object) -> str:
+        if not self.fields:
+            return self.text
+        try:
+            return self._format(**kwargs)
+        except KeyError as exc:
+            msg = f'{self.code} ({self.lang_code}) is missing {exc} among {sorted(kwargs)}'
+            raise exceptions.TemplateError(msg) from exc
+
+
+def _parse_fields(code: str, lang_code: str, text: str) -> frozenset[str]:
+    try:
+        fields = frozenset(field for _, field, _, _ in _formatter.parse(text) if field is not None)
+    except ValueError as exc:
+        msg = f'{code} ({lang_code}) is not a valid template: {exc}'
+        raise exceptions.TemplateError(msg) from exc
+    invalid = sorted(field for field in fields if not field.isidentifier())
+    if invalid:
+        msg = f'{code} ({lang_code}) has placeholders {invalid}, only plain names are supported'
+        raise exceptions.TemplateError(msg)
+    return fields
+
+
+def compile_templates(catalog: tp.Mapping[str, tp.Mapping[str, str]]) -> dict[str, dict[str, Template]]:
+    """Compile every message of `catalog`, all languages of a message must have the same placeholders."""
+    templates: dict[str, dict[str, Template]] = {}
+    for code, texts in catalog.items():
+        compiled = {lang_code: Template(code, lang_code, text) for lang_code, text in texts.items()}
+        if len({template.fields for template in compiled.values()}) > 1:
+            fields = {lang_code: sorted(template.fields) for lang_code, template in compiled.items()}
+            msg = f'{code} has different placeholders in different languages: {fields}'
+            raise exceptions.TemplateError(msg)
+        templates[code] = compiled
+    return templates
+
+
+def compile_who_actions(lang_code: str) -> Template:
+    """Compile the /pass and /deny commands of a pending meeting, the login is the only placeholder."""
+    done = TEMPLATES[messages.MEETING_ALREADY_DONE_LABEL][lang_code].text
+    nope = TEMPLATES[messages.MEETING_IS_DECLINED_LABEL][lang_code].text
+    text = f'\n{done}: /pass_\0\n{nope}: /deny_\0\n'
+    # the escaped labels must not turn into placeholders, so braces are escaped after markdown
+    text = escape_markdown(text).replace('{', '{{').replace('}', '}}').replace('\0', '{login}')
+    return Template(messages.MEETING_ALREADY_DONE_LABEL, lang_code, text)
+
+
+def compile_status_texts(lang_code: str) -> dict[models.MeetingStatus, str]:
+    """Map statuses to texts, the texts of `MEETING_STATUS_TEXTS` start at `yet`."""
+    choices = messages.MULTI_MESSAGES[messages.MEETING_STATUS_TEXTS][lang_code]
+    statuses: list[models.MeetingStatus] = list(models.MeetingStatus)
+    texts: dict[models.MeetingStatus, str] = {}
+    for idx, status in enumerate(statuses):
+        if max(idx - 3, 0) < len(choices):
+            texts[status] = choices[max(idx - 3, 0)]
+    return texts
+
+
+TEMPLATES = compile_templates(messages.MESSAGES)
+LANG_CODES = frozenset(lang_code for texts in messages.MESSAGES.values() for lang_code in texts)
+WHO_ACTIONS = {lang_code: compile_who_actions(lang_code) for lang_code in LANG_CODES}
+STATUS_TEXTS = {lang_code: compile_status_texts(lang_code) for lang_code in LANG_CODES}
+
+
+def get_template(msg_code: str, lang_code: str) -> Template:
+    template = TEMPLATES.get(msg_code, {}).get(lang_code)
+    if template is None:
+        logger.info(f'Unknown {lang_code=} for {msg_code=}')  # noqa: G004
+        return TEMPLATES[messages.UNKNOWN_TEXT_MESSAGE][FALLBACK_LANG_CODE]
+    return template
+
+
+def render(msg_code: str, lang_code: str, **kwargs: object) -> str:
+    return get_template(msg_code, lang_code).render(**kwargs)
+
+
+def get_who_actions(lang_code: str) -> Template:
+    return WHO_ACTIONS.get(lang_code) or WHO_ACTIONS[FALLBACK_LANG_CODE]
+
+
+def get_status_texts(lang_code: str) -> dict[models.MeetingStatus, str]:
+    return STATUS_TEXTS.get(lang_code) or STATUS_TEXTS[FALLBACK_LANG_CODE]
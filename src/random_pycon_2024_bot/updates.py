@@ -0,0 +1,200 @@
+import asyncio
+import collections
+import dataclasses
+import enum
+import time
+import typing as tp
+
+import telegram as t
+import telegram.ext as te
+
+from random_pycon_2024_bot import exceptions
+from random_pycon_2024_bot import locks
+from random_pycon_2024_bot import models
+
+# what a full queue does with an update: drop an inline query or a plain text first, or reject it
+QueuePolicy = tp.Literal['shed', 'reject']
+
+
+@enum.unique
+class Offer(enum.StrEnum):
+    queued = enum.auto()
+    shed = enum.auto()
+    rejected = enum.auto()
+
+
+@dataclasses.dataclass
+class QueueStats:
+    policy: str
+    depth: int
+    max_depth: int
+    maxsize: int
+    in_flight: int
+    # seconds the oldest queued update has been waiting
+    oldest_age: float
+    queued: int
+    shed: int
+    rejected: int
+
+
+def get_update_key(update: object) -> str | None:
+    """Return the user whose updates have to be handled in order, or the chat if there is no user."""
+    if isinstance(update, t.Update):
+        if update.effective_user is not None:
+            return str(update.effective_user.id)
+        if update.effective_chat is not None:
+            return str(update.effective_chat.id)
+    if isinstance(update, models.WebhookUpdate):
+        return str(update.user_id)
+    return None
+
+
+class UserOrderedUpdateProcessor(te.BaseUpdateProcessor):
+    """
+    Handle updates of different users concurrently and updates of one user in the order they came.
+
+    `max_pending_updates` bounds the updates taken from the queue, the ones waiting for an earlier update
+    of their user included, and `max_concurrent_updates` bounds the handlers running at once. A slow user
+    holds only their own updates back, not the slots of handlers.
+
+    Handlers share `bot_data`, which is safe as long as its state is not changed across an `await`:
+    the `db` mutators don't await, so each of them runs atomically on the event loop.
+    """
+
+    __slots__ = ('_handlers', '_user_locks')
+
+    def __init__(self, max_concurrent_updates: int, max_pending_updates: int) -> None:
+        # the semaphore of the base class is taken before `do_process_update`, so it bounds pending updates
+        super().__init__(max(max_pending_updates, max_concurrent_updates))
+        self._handlers = asyncio.BoundedSemaphore(max_concurrent_updates)
+        self._user_locks = locks.KeyedLocks()
+
+    @property
+    def pending_users(self) -> int:
+        return len(self._user_locks)
+
+    async def do_process_update(self, update: object, coroutine: tp.Awaitable[tp.Any]) -> None:
+        # updates are taken from the queue by tasks started in order, and the locks are FIFO
+        key = get_update_key(update)
+        if key is None:
+            async with self._handlers:
+                await coroutine
+            return
+        async with self._user_locks.hold(key), self._handlers:
+            await coroutine
+
+    async def initialize(self) -> None:
+        pass
+
+    async def shutdown(self) -> None:
+        pass
+
+
+def is_sheddable(update: object) -> bool:
+    """Inline queries and plain texts are only echoed, so they are the first to go under load."""
+    if not isinstance(update, t.Update):
+        return False
+    if update.inline_query is not None:
+        return True
+    message = update.message
+    return message is not None and message.text is not None and not message.text.startswith('/')
+
+
+class UpdateQueue(asyncio.Queue[object]):
+    """
+    Bounded `update_queue`, `offer` sheds or rejects the updates that don't fit according to `policy`.
+
+    When updates are handled concurrently, the application takes every update off the queue right away.
+    So `get` waits until fewer than `max_in_flight` updates are being handled, and the backlog stays here,
+    where it is bounded, measured and can be shed.
+    """
+
+    def __init__(self, maxsize: int, max_in_flight: int, policy: QueuePolicy = 'shed') -> None:
+        super().__init__(maxsize)
+        self.policy = policy
+        self._slots = asyncio.Semaphore(max_in_flight)
+        self._in_flight = 0
+        self._max_depth = 0
+        self._offers: collections.Counter[Offer] = collections.Counter()
+
+    def _init(self, maxsize: int) -> None:  # noqa: ARG002
+        self._queue: collections.deque[object] = collections.deque()
+        self._enqueued_at: collections.deque[float] = collections.deque()
+        self._sheddable = 0
+
+    def _put(self, item: object) -> None:
+        self._queue.append(item)
+        self._enqueued_at.append(time.monotonic())
+        self._sheddable += is_sheddable(item)
+        self._max_depth = max(self._max_depth, len(self._queue))
+
+    def _get(self) -> object:
+        self._enqueued_at.popleft()
+        item = self._queue.popleft()
+        self._sheddable -= is_sheddable(item)
+        return item
+
+    async def get(self) -> object:
+        """Wait for a slot of the updates in flight, then for an update."""
+        await self._slots.acquire()
+        try:
+            item = await super().get()
+        except BaseException:
+            self._slots.release()
+            raise
+        self._in_flight += 1
+        return item
+
+    def task_done(self) -> None:
+        """Mark an update as handled and free its slot."""
+        super().task_done()
+        # updates dropped on shutdown are marked done without a slot
+        if self._in_flight:
+            self._in_flight -= 1
+            self._slots.release()
+
+    def offer(self, update: object) -> Offer:
+        """Put `update` if there is room, a full queue sheds a low-priority update or rejects `update`."""
+        if self.full() and self.policy == 'shed':
+            if is_sheddable(update):
+                return self._count(Offer.shed)
+            self._shed_queued()
+        if self.full():
+            return self._count(Offer.rejected)
+        self.put_nowait(update)
+        return self._count(Offer.queued)
+
+    def stats(self) -> QueueStats:
+        return QueueStats(
+            policy=self.policy,
+            depth=self.qsize(),
+            max_depth=self._max_depth,
+            maxsize=self.maxsize,
+            in_flight=self._in_flight,
+            oldest_age=time.monotonic() - self._enqueued_at[0] if self._enqueued_at else 0.0,
+            queued=self._offers[Offer.queued],
+            shed=self._offers[Offer.shed],
+            rejected=self._offers[Offer.rejected],
+        )
+
+    def _count(self, offer: Offer) -> Offer:
+        self._offers[offer] += 1
+        return offer
+
+    def _shed_queued(self) -> None:
+        if not self._sheddable:
+            return
+        idx = next(idx for idx, item in enumerate(self._queue) if is_sheddable(item))
+        del self._queue[idx], self._enqueued_at[idx]
+        self._sheddable -= 1
+        # the update is done without being handled
+        super().task_done()
+        self._count(Offer.shed)
+
+
+def get_update_queue(application: te.Application) -> UpdateQueue:  # type: ignore[type-arg]
+    update_queue = application.update_queue
+    if not isinstance(update_queue, UpdateQueue):
+        msg = 'The application is built without an UpdateQueue'
+        raise exceptions.AppError(msg)
+    return update_queue
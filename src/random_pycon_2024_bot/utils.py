@@ -1,12 +1,9 @@
-import functools
 import logging
 import typing as tp
 
 import telegram as t
 import telegram.constants as tc
 
-from random_pycon_2024_bot import messages
-
 logger = logging.getLogger(__name__)
 
 _T = tp.TypeVar('_T')
@@ -19,20 +16,6 @@ def notnull(value: _T | None) -> _T:
     return value
 
 
-@functools.cache
-def get_message(msg_code: str, lang_code: str) -> str:
-    message = messages.MESSAGES.get(msg_code, {}).get(lang_code)
-    if message is None:
-        logger.info(f'Unknown {lang_code=} for {msg_code=}')  # noqa: G004
-        return messages.UNKNOWN_TEXT_MESSAGE_RU
-    return message
-
-
-@functools.cache
-def get_multi_message(msg_code: str, lang_code: str) -> list[str]:
-    return messages.MULTI_MESSAGES.get(msg_code, {}).get(lang_code) or []
-
-
 def get_command_value(message: t.Message) -> str | None:
     for ent in message.entities:
         if ent.type == tc.MessageEntityType.BOT_COMMAND: